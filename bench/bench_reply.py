@@ -0,0 +1,194 @@
+"""
+Мікробенчмарк пост-обробки відповідей: конвеєр ReplyPipeline проти старих
+neri_style / enforce_neri_pronouns / combine_reply.
+
+    python bench/bench_reply.py [--rounds N]
+
+Спершу перевіряє, що на тих самих seed обидва варіанти дають однаковий текст,
+потім міряє час на одну відповідь.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from main import _one, n_emo  # noqa: E402
+
+# сирі таблиці — з того ж пакета персони, що й у бота
+with open(main.PERSONA_PACK, encoding="utf-8") as f:
+    PACK = json.load(f)
+HI_REPLIES, MOM_REPLIES, DAD_REPLIES, ABOUT_REPLIES, INTERESTING_REPLIES = (
+    PACK["replies"][k] for k in ("hi", "mom", "dad", "about", "interesting")
+)
+HEADERS = PACK["smalltalk"]["headers"]
+TAIL_VIBES, TAIL_QUESTIONS, TAIL_SUPPORT = (PACK["smalltalk"]["tails"][k] for k in ("vibes", "questions", "support"))
+SMALLTALK = [(k["patterns"], k["replies"], k["kind"]) for k in PACK["smalltalk"]["kinds"]]
+
+
+# ===== старий варіант (як був у main.py) =====
+FEM_TO_MASC_REPLACEMENTS = [
+    (r"\bя була\b", "я був"),
+    (r"\bя зробила\b", "я зробив"),
+    (r"\bя сказала\b", "я сказав"),
+    (r"\bя відповіла\b", "я відповів"),
+    (r"\bя хотіла\b", "я хотів"),
+    (r"\bя могла\b", "я міг"),
+    (r"\bя не могла\b", "я не міг"),
+    (r"\bя забула\b", "я забув"),
+    (r"\bя зрозуміла\b", "я зрозумів"),
+    (r"\bя думала\b", "я думав"),
+    (r"\bя бачила\b", "я бачив"),
+    (r"\bя пішла\b", "я пішов"),
+    (r"\bя прийшла\b", "я прийшов"),
+    (r"\bя стала\b", "я став"),
+]
+
+def legacy_enforce_neri_pronouns(text: str) -> str:
+    t = (text or "").strip()
+    if not t:
+        return t
+    for pattern, repl in FEM_TO_MASC_REPLACEMENTS:
+        t = re.sub(pattern, repl, t, flags=re.IGNORECASE)
+    return t
+
+def legacy_neri_style(text: str) -> str:
+    if not text:
+        return text
+
+    t = text.strip()
+
+    # 25% шанс зробити одне слово/фразу капсом
+    if random.random() < 0.25:
+        words = t.split()
+        if len(words) >= 3:
+            i = random.randint(0, len(words) - 1)
+            words[i] = words[i].upper()
+            t = " ".join(words)
+
+    # емодзі інколи
+    if random.random() < 0.25 and len(t) < 260:
+        if not t.endswith(("🌿","✨","💚","😼","👀","🍃","🌱","🍀","🪴","🌸","🌼")):
+            t = t + " " + n_emo()
+
+    t = legacy_enforce_neri_pronouns(t)
+    return t
+
+def legacy_dedupe_join(parts: list[str]) -> str:
+    out = []
+    seen = set()
+    for p in parts:
+        p = (p or "").strip()
+        if not p:
+            continue
+        k = p.lower()
+        if k in seen:
+            continue
+        seen.add(k)
+        out.append(p)
+    return " ".join(out).strip()
+
+def legacy_combine_reply(base: str, kind: str) -> str:
+    base = (base or "").strip()
+    if not base:
+        return base
+
+    parts = []
+    if random.random() < 0.35:
+        h = _one(HEADERS).strip()
+        if h:
+            parts.append(h)
+
+    parts.append(base)
+
+    tails_pool = TAIL_VIBES + TAIL_QUESTIONS + (TAIL_SUPPORT if kind in ("how", "day") else [])
+    if random.random() < 0.60:
+        parts.append(_one(tails_pool))
+    if random.random() < 0.25:
+        parts.append(_one(tails_pool))
+
+    res = legacy_dedupe_join(parts)
+    if len(res) > 260:
+        res = legacy_dedupe_join(parts[:3])
+    return res
+
+SMALLTALK_BLOCK = ["вмі", "команд", "віднос", "відношенн", "ставиш", "думаєш", "хто", "покар", "накаж", "мут", "погод", "рок", "народж", "привітай", "займенник"]
+
+# по одному скомпільованому regex на кожен вид, порядок видів — пріоритет
+SMALLTALK_COMPILED = [
+    (re.compile("|".join(f"(?:{p})" for p in patterns)), replies, kind)
+    for patterns, replies, kind in SMALLTALK
+]
+
+# ===== корпус =====
+STYLE_TEXTS = (
+    HI_REPLIES + MOM_REPLIES + DAD_REPLIES + ABOUT_REPLIES + INTERESTING_REPLIES
+    + [m for prof in PACK["profiles"].values() for m in prof.get("opinions", [])]
+    + [
+        "Вчора я була в саду і я зробила чай 🌿",
+        "Я не могла відповісти, бо я забула телефон",
+        "Я думала, що я пішла рано, але я прийшла вчасно",
+        "Я БУЛА тут. Я Стала сильнішою",
+        "Кого карати? Напиши так: «Нері, покарай Торі» 👀",
+        "Я не говорю про політику/війну 🌿 Давай краще про щось тепле й командне 💚",
+    ]
+)
+SMALLTALK_BASES = [(base, kind) for _, replies, kind in SMALLTALK for base in replies]
+
+
+def check_same(seeds: int = 200):
+    for seed in range(seeds):
+        for t in STYLE_TEXTS:
+            random.seed(seed)
+            a = legacy_neri_style(t)
+            random.seed(seed)
+            b = main.neri_style(t)
+            if a != b:
+                raise SystemExit(f"neri_style MISMATCH seed={seed} {t!r}:\n  {a!r}\n  {b!r}")
+        for base, kind in SMALLTALK_BASES:
+            random.seed(seed)
+            a = legacy_neri_style(legacy_combine_reply(base, kind))
+            random.seed(seed)
+            b = main.SMALLTALK_STYLE.run(base, kind)
+            if a != b:
+                raise SystemExit(f"smalltalk MISMATCH seed={seed} {base!r}:\n  {a!r}\n  {b!r}")
+
+
+def bench(fn, items, rounds: int, repeat: int = 5) -> float:
+    """Найкращий із repeat прогонів, мкс на відповідь."""
+    best = float("inf")
+    for _ in range(repeat):
+        random.seed(1)
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            for it in items:
+                fn(*it)
+        best = min(best, time.perf_counter() - t0)
+    return best / (rounds * len(items)) * 1e6
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=300)
+    args = ap.parse_args()
+
+    check_same()
+    print(f"{len(STYLE_TEXTS)} styled + {len(SMALLTALK_BASES)} smalltalk replies, identical output on 200 seeds")
+
+    items = [(t,) for t in STYLE_TEXTS]
+    old = bench(legacy_neri_style, items, args.rounds)
+    new = bench(main.neri_style, items, args.rounds)
+    print("neri_style:")
+    print(f"  legacy:   {old:7.2f} us/reply")
+    print(f"  pipeline: {new:7.2f} us/reply  ({old / new:.2f}x)")
+
+    old = bench(lambda b, k: legacy_neri_style(legacy_combine_reply(b, k)), SMALLTALK_BASES, args.rounds)
+    new = bench(main.SMALLTALK_STYLE.run, SMALLTALK_BASES, args.rounds)
+    print("smalltalk (combine_reply + neri_style):")
+    print(f"  legacy:   {old:7.2f} us/reply")
+    print(f"  pipeline: {new:7.2f} us/reply  ({old / new:.2f}x)")
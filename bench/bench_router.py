@@ -0,0 +1,306 @@
+"""
+Мікробенчмарк маршрутизації: таблиця намірів (IntentRouter) проти старого ланцюжка if/elif.
+
+    python bench/bench_router.py [--rounds N]
+
+Спершу перевіряє, що на тому ж seed обидва варіанти дають однакову відповідь
+на кожне повідомлення, потім міряє час на повідомлення.
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from main import *  # noqa: E402,F401,F403
+
+# пули відповідей тепер у пакеті персони
+_REPLIES = main.PERSONA.replies
+ABOUT_REPLIES = list(_REPLIES["about"])
+INTERESTING_REPLIES = list(_REPLIES["interesting"])
+AGE_REPLIES = list(_REPLIES["age"])
+BDAY_REPLIES = list(_REPLIES["bday"])
+MOM_REPLIES = list(_REPLIES["mom"])
+DAD_REPLIES = list(_REPLIES["dad"])
+
+# погода без мережі — міряємо тільки маршрутизацію
+def get_weather(city: str) -> str:
+    return f"погода: {city}"
+
+def get_weather_many(cities: list[str], when: str = "now") -> str:
+    return "\n".join(get_weather(c) for c in cities)
+
+main.get_weather = get_weather
+main.get_weather_many = get_weather_many
+
+MESSAGES = [
+    "Нері, привіт",
+    "нері хай",
+    "Нері, як ти?",
+    "Нері, як справи",
+    "нері шо робиш",
+    "Нері, що робив вчора",
+    "Нері, як день?",
+    "Нері, погода в Києві",
+    "нері яка погода у Львові зараз",
+    "Нері, погода",
+    "Нері, монетка",
+    "Нері, кубик",
+    "нері, дай число",
+    "Нері, назви випадкового учасника",
+    "Нері, покарай Торі",
+    "нері накажи \"Рум\"",
+    "Нері, команди",
+    "Нері, що ти вмієш?",
+    "Нері, привітайся",
+    "Нері, розкажи про себе",
+    "Нері, розкажи щось цікаве",
+    "Нері, скільки тобі років",
+    "Нері, коли в тебе день народження",
+    "Нері, хто твоя мама",
+    "Нері, хто твій тато",
+    "Нері, хто такий Рум",
+    "нері що за лірен",
+    "Нері, як ти відносишся до Торі",
+    "Нері, що ти думаєш про Дейза",
+    "Нері, твої займенники?",
+    "Нері, що думаєш про вибори",
+    "Нері, ммм",
+    "нері ти тут? дивись який мем",
+    "нері, я сьогодні втомилась, але все ок",
+    "монетка",
+    "кубик",
+    "число",
+    "/start",
+    "/help",
+    "ну і де всі",
+]
+
+
+# ===== старий ланцюжок (як був у telegram_webhook) =====
+def is_pronouns_query(q: str) -> bool:
+    return ("займенник" in q) or ("займенники" in q) or ("pronouns" in q)
+
+def is_mom_query(q: str) -> bool:
+    return ("хто" in q) and ("мама" in q or "матуся" in q or "матi" in q or "мать" in q)
+
+def is_dad_query(q: str) -> bool:
+    return ("хто" in q) and ("тато" in q or "татусь" in q or "батько" in q)
+
+def is_serious_topic(q: str) -> bool:
+    return any(k in q for k in SERIOUS_KEYWORDS)
+
+def is_cmds_query(q: str) -> bool:
+    if re.search(r"\bкоманд(и|а)?\b", q):
+        return True
+    if ("що" in q and "вмі" in q):
+        return True
+    return False
+
+def is_random_member_query(q: str) -> bool:
+    return ("випадков" in q) and ("учасник" in q or "учасника" in q or "мембер" in q or "member" in q)
+
+def is_hi_query(q: str) -> bool:
+    qq = (q or "").strip().lower()
+    return qq in ("привіт", "привiт", "хай", "хей", "йо", "hello", "hi")
+
+def is_about_query(q: str) -> bool:
+    return ("розкажи" in q and "про" in q and "себе") or ("хто" in q and "ти" in q)
+
+def is_interesting_query(q: str) -> bool:
+    return ("розкажи" in q and ("цікав" in q or "цікавеньк" in q)) or ("розкажи" in q and "щось" in q)
+
+def is_age_query(q: str) -> bool:
+    return ("скільки" in q and "рок" in q) or ("вік" in q)
+
+def is_bday_query(q: str) -> bool:
+    return ("день" in q and "народж") or ("коли" in q and "народж" in q)
+
+def is_greet_new_query(q: str) -> bool:
+    return "привітайся" in q or "привітай" in q
+
+def detect_smalltalk(q: str) -> str | None:
+    m = match_smalltalk(q)
+    if not m:
+        return None
+    replies, kind = m
+    return combine_reply(random.choice(replies), kind)
+
+
+def legacy_route(raw_text: str):
+    text = raw_text.lower()
+
+    reply = None
+
+    if text == "/start":
+        reply = (
+            "Привіт ✨ Я Нері.\n\n"
+            "Я маскот і символ команди 💚🌿\n\n"
+            "Спробуй:\n"
+            "• Нері, команди\n"
+            "• Нері, привітайся\n"
+            "• Нері, погода в Києві\n"
+            "• Нері, хто такий Рум\n"
+            "• Нері, як ти відносишся до Торі\n"
+            "• Нері, покарай Торі"
+        )
+
+    elif text == "/help":
+        reply = commands_text()
+
+    elif "нері" in text:
+        q = clean_text(raw_text)
+
+        # табу
+        if is_serious_topic(q):
+            reply = serious_refusal()
+
+        # ===== "Нері, привіт" ✅ ДОДАНО =====
+        elif is_hi_query(q):
+            reply = neri_style(hi_reply())
+
+        # займенники ✅ ДОДАНО
+        elif is_pronouns_query(q):
+            reply = neri_style(pronouns_reply())
+
+        # погода
+        elif "погод" in q or "погода" in q:
+            city = extract_city_from_query(q)
+            reply = get_weather(city) if city else "Скажи місто 🌿 Наприклад: «Нері, погода в Києві»"
+
+        # ===== ігри (монетка/кубик/число) ✅ ДОДАНО =====
+        elif q.strip() in ("монетка", "орел решка", "орел/решка", "орел", "решка"):
+            reply = neri_style(coin())
+        elif q.strip() in ("кубик", "дай кубик", "кістка"):
+            reply = neri_style(dice())
+        elif q.strip() in ("число", "дай число", "рандом число", "рандомне число"):
+            reply = neri_style(number_1_100())
+
+        # ===== випадковий учасник ✅ ДОДАНО =====
+        elif is_random_member_query(q):
+            reply = neri_style(random_member_reply())
+
+        else:
+            # 0) покарай (жарт)
+            punish = handle_punish(raw_text, q)
+            if punish:
+                reply = punish
+
+            # 1) команди
+            elif is_cmds_query(q):
+                reply = commands_text()
+
+            # 2) привітання нового учасника
+            elif is_greet_new_query(q):
+                reply = neri_style(greet_new_member_text())
+
+            # 3) про себе
+            elif is_about_query(q):
+                reply = neri_style(random.choice(ABOUT_REPLIES))
+
+            # 4) щось цікаве
+            elif is_interesting_query(q):
+                reply = neri_style(random.choice(INTERESTING_REPLIES))
+
+            # 5) вік / день народження
+            elif is_age_query(q):
+                reply = neri_style(random.choice(AGE_REPLIES))
+
+            elif is_bday_query(q):
+                reply = neri_style(random.choice(BDAY_REPLIES))
+
+            # 6) мама/тато (ПРЯМО)
+            elif is_mom_query(q):
+                reply = neri_style(random.choice(MOM_REPLIES))
+
+            elif is_dad_query(q):
+                reply = neri_style(random.choice(DAD_REPLIES))
+
+            else:
+                # 7) хто такий/така (ОКРЕМО)
+                who = answer_who_is(raw_text, q)
+                if who:
+                    reply = who
+                else:
+                    # 8) як відносишся/думаєш (ОКРЕМО)
+                    op = handle_member_opinion(raw_text, q)
+                    if op:
+                        reply = op
+                    else:
+                        # 9) smalltalk
+                        st = detect_smalltalk(q)
+                        if st:
+                            reply = neri_style(st)
+                        else:
+                            # 10) розумний фолбек
+                            reply = neri_style(random.choice([
+                                "Я підвис на сенсі 😼🌿 Дай 1–2 ключові слова — і я підхоплю ✨",
+                                "Я не зловив тему 🍃 Але я поруч. Кинь контекст одним рядком 👀",
+                                "Окей, я тут 🌿 Це про команду, про погоду, чи просто побалакати? ✨",
+                                "Я можу відповісти краще, якщо скажеш: це питання про людей/чат чи щось інше 🌱",
+                            ]))
+
+    # базові штуки без "нері" (якщо хочеш — можна прибрати)
+    else:
+        if text.strip() in ("монетка", "орел решка"):
+            reply = neri_style(coin())
+        elif text.strip() in ("кубик", "дай кубик"):
+            reply = neri_style(dice())
+        elif text.strip() in ("число", "дай число"):
+            reply = neri_style(number_1_100())
+
+    return reply
+
+
+def new_route(raw_text: str):
+    return main.route_message(raw_text)[1]
+
+
+def check_same(seed: int = 7):
+    for msg in MESSAGES:
+        random.seed(seed)
+        a = legacy_route(msg)
+        random.seed(seed)
+        b = new_route(msg)
+        if a != b:
+            raise SystemExit(f"MISMATCH for {msg!r}:\n  legacy: {a!r}\n  router: {b!r}")
+
+
+def bench(fn, rounds: int, repeat: int = 5) -> float:
+    """Найкращий із repeat прогонів, мкс на повідомлення (як timeit)."""
+    best = float("inf")
+    for _ in range(repeat):
+        random.seed(1)
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            for msg in MESSAGES:
+                fn(msg)
+        best = min(best, time.perf_counter() - t0)
+    return best / (rounds * len(MESSAGES)) * 1e6
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=500)
+    args = ap.parse_args()
+
+    check_same()
+    print(f"{len(MESSAGES)} messages, identical replies on a fixed seed")
+
+    old = bench(legacy_route, args.rounds)
+    new = bench(new_route, args.rounds)
+    print("with reply post-processing:")
+    print(f"  legacy if/elif chain: {old:7.2f} us/msg")
+    print(f"  intent router:        {new:7.2f} us/msg  ({old / new:.2f}x)")
+
+    # без neri_style лишається тільки вибір обробника
+    globals()["neri_style"] = main.neri_style = lambda t: t
+    old = bench(legacy_route, args.rounds)
+    new = bench(new_route, args.rounds)
+    print("routing only (neri_style stubbed):")
+    print(f"  legacy if/elif chain: {old:7.2f} us/msg")
+    print(f"  intent router:        {new:7.2f} us/msg  ({old / new:.2f}x)")
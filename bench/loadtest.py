@@ -0,0 +1,317 @@
+"""
+Навантажувальний тест webhook'а повністю офлайн.
+
+    python bench/loadtest.py [--duration 20] [--concurrency 32]
+                             [--tg-latency 0.03] [--tg-error-rate 0.01]
+                             [--owm-latency 0.08] [--owm-error-rate 0.02]
+
+Піднімає в цьому процесі фейкові Bot API та OpenWeatherMap (окремий потік, свій
+event loop), запускає main:app через uvicorn окремим процесом із TELEGRAM_API_BASE
+та OWM_API на фейки і шле на /webhook український трафік, що покриває всі наміри.
+Звіт: пропускна здатність і p50/p95/p99 відповіді webhook'а по кожному наміру.
+"""
+import os
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:loadtest"
+
+# ===== Трафік =====
+CITIES = [
+    "Києві", "Львові", "Одесі", "Харкові", "Дніпрі", "Вінниці", "Полтаві",
+    "Чернігові", "Ужгороді", "Луцьку", "Тернополі", "Франику",
+]
+# немає в газетирі — піде через геокодування
+REMOTE_CITIES = ["Варшаві", "Берліні", "Кракові", "Празі", "Вільнюсі", "Жмеринці", "Бахмачі"]
+MEMBERS = ["Рум", "Лірен", "Рітерум", "Liren", "Лiрен"]
+
+# (намір, вага, шаблони); {city}, {remote}, {member} підставляються випадково
+TRAFFIC = [
+    ("start", 1, ["/start"]),
+    ("help", 1, ["/help"]),
+    ("hi", 8, ["Нері, привіт", "нері хай", "Нері йо"]),
+    ("serious", 1, ["Нері, що думаєш про політику", "Нері, а як щодо війни"]),
+    ("pronouns", 1, ["Нері, які в тебе займенники?"]),
+    ("weather", 10, ["Нері, погода в {city}", "нері яка погода у {city} зараз", "Нері, погода {city}"]),
+    ("weather_remote", 3, ["Нері, погода в {remote}"]),
+    ("weather_multi", 3, ["Нері, погода в {city}, {city} та {city}", "нері погода у {city} і {remote}"]),
+    ("forecast_tomorrow", 3, ["Нері, погода завтра в {city}", "нері яка погода завтра у {remote}"]),
+    ("forecast_week", 2, ["Нері, прогноз погоди на тиждень у {city}", "Нері, погода на тиждень в {city} та {city}"]),
+    ("weather_prompt", 1, ["Нері, погода"]),
+    ("coin", 3, ["Нері, монетка", "монетка"]),
+    ("dice", 3, ["Нері, кубик", "кубик"]),
+    ("number", 2, ["Нері, дай число", "число"]),
+    ("random_member", 2, ["Нері, випадковий учасник"]),
+    ("punish", 2, ["Нері, покарай {member}", "Нері, накажи {member}"]),
+    ("cmds", 2, ["Нері, команди", "Нері, що ти вмієш?"]),
+    ("greet_new", 1, ["Нері, привітай новеньких"]),
+    ("about", 2, ["Нері, розкажи про себе", "Нері, хто ти?"]),
+    ("interesting", 2, ["Нері, розкажи щось цікаве"]),
+    ("age", 1, ["Нері, скільки тобі років?"]),
+    ("bday", 1, ["Нері, коли твій день народження?"]),
+    ("mom", 1, ["Нері, хто твоя мама?"]),
+    ("dad", 1, ["Нері, хто твій тато?"]),
+    ("who_is", 3, ["Нері, хто такий {member}?", "Нері, що за «{member}»"]),
+    ("opinion", 3, ["Нері, як ти відносишся до {member}?", "Нері, що думаєш про {member}"]),
+    ("smalltalk", 8, ["Нері, як справи?", "нері шо робиш", "Нері, що робив вчора", "Нері, як день?"]),
+    ("fallback", 3, ["Нері, банан", "Нері, ну таке"]),
+    ("plain", 10, ["всім привіт", "хто йде гуляти?", "лол", "ахаха ну ви даєте"]),
+]
+
+
+def traffic(seed: int):
+    rnd = random.Random(seed)
+    weights = [w for _, w, _ in TRAFFIC]
+    update_id = 0
+    while True:
+        intent, _, templates = rnd.choices(TRAFFIC, weights)[0]
+        # кожне входження {city} — своє місто (запити на кілька міст)
+        text = rnd.choice(templates)
+        while "{city}" in text:
+            text = text.replace("{city}", rnd.choice(CITIES), 1)
+        text = text.replace("{remote}", rnd.choice(REMOTE_CITIES)).replace("{member}", rnd.choice(MEMBERS))
+        update_id += 1
+        # кожне повідомлення — свій чат, щоб не впиратися в ліміти одного чату
+        chat_id = 10_000_000 + update_id if rnd.random() < 0.8 else -(10_000_000 + update_id)
+        yield intent, {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                "from": {"id": 500 + update_id % 997, "is_bot": False, "first_name": "Тест"},
+                "text": text,
+            },
+        }
+
+
+# ===== Фейкові upstream'и =====
+def make_fakes(args) -> tuple[FastAPI, dict]:
+    counters = {"telegram": 0, "telegram_errors": 0, "geocode": 0, "weather": 0, "forecast": 0, "owm_errors": 0}
+    app = FastAPI()
+
+    def fake_error():
+        return JSONResponse({"cod": 500, "message": "internal error"}, status_code=500)
+
+    async def delay(mean: float):
+        if mean > 0:
+            await asyncio.sleep(mean * random.uniform(0.5, 1.5))
+
+    @app.post("/bot{token}/{method}")
+    async def bot_api(token: str, method: str, request: Request):
+        counters["telegram"] += 1
+        await delay(args.tg_latency)
+        if method == "sendMessage" and random.random() < args.tg_error_rate:
+            counters["telegram_errors"] += 1
+            return {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 1}}
+        if method == "getWebhookInfo":
+            return {"ok": True, "result": {"url": "", "pending_update_count": 0}}
+        return {"ok": True, "result": True}
+
+    @app.get("/geo/1.0/direct")
+    async def geocode(q: str):
+        counters["geocode"] += 1
+        await delay(args.owm_latency)
+        if random.random() < args.owm_error_rate:
+            counters["owm_errors"] += 1
+            return fake_error()
+        name = q.split(",")[0]
+        h = abs(hash(name))
+        return [{"name": name, "lat": 45 + h % 700 / 100, "lon": 22 + h % 1800 / 100, "country": "UA",
+                 "local_names": {"uk": name.capitalize()}}]
+
+    @app.get("/data/2.5/weather")
+    async def weather(lat: float, lon: float):
+        counters["weather"] += 1
+        await delay(args.owm_latency)
+        if random.random() < args.owm_error_rate:
+            counters["owm_errors"] += 1
+            return fake_error()
+        return {
+            "main": {"temp": 10 + lat % 7, "feels_like": 8 + lon % 7},
+            "weather": [{"main": "Clouds", "description": "хмарно"}],
+        }
+
+    @app.get("/data/2.5/forecast")
+    async def forecast(lat: float, lon: float):
+        counters["forecast"] += 1
+        await delay(args.owm_latency)
+        if random.random() < args.owm_error_rate:
+            counters["owm_errors"] += 1
+            return fake_error()
+        # 5 днів по 3 години, як у справжнього OWM
+        start = int(time.time()) // 10800 * 10800
+        return {
+            "city": {"timezone": 10800},
+            "list": [
+                {
+                    "dt": start + i * 10800,
+                    "main": {"temp": 5 + lat % 7 + (i % 8), "feels_like": 3 + lon % 7 + (i % 8)},
+                    "weather": [{"main": "Rain", "description": "дощ"} if i % 3 else {"main": "Clear", "description": "ясно"}],
+                }
+                for i in range(40)
+            ],
+        }
+
+    return app, counters
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_in_thread(app, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.02)
+    return server
+
+
+def start_bot(fake_url: str, args, workdir: str) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    env = dict(
+        os.environ,
+        BOT_TOKEN=BOT_TOKEN,
+        WEBHOOK_URL="http://127.0.0.1/webhook",
+        WEATHER_API_KEY="loadtest",
+        TELEGRAM_API_BASE=fake_url,
+        OWM_API=fake_url,
+        GEOCODE_DB=os.path.join(workdir, "geocode.sqlite3"),
+        WEATHER_CACHE_TTL=str(args.cache_ttl),
+        OUTBOUND_GLOBAL_RATE="100000",
+        LOG_LEVEL="WARNING",
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL if args.quiet else None,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit("bot exited during startup")
+        try:
+            if httpx.get(url + "/", timeout=1).status_code == 200:
+                return proc, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    proc.kill()
+    raise SystemExit("bot did not start")
+
+
+# ===== Навантаження =====
+async def run_load(url: str, args) -> tuple[dict, float]:
+    samples: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    gen = traffic(args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        async def worker(deadline: float, record: bool):
+            while time.monotonic() < deadline:
+                intent, update = next(gen)
+                t0 = time.perf_counter()
+                try:
+                    r = await client.post("/webhook", json=update)
+                    ok = r.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                dt = time.perf_counter() - t0
+                if not record:
+                    continue
+                samples.setdefault(intent, []).append(dt)
+                if not ok:
+                    errors[intent] = errors.get(intent, 0) + 1
+
+        if args.warmup > 0:
+            deadline = time.monotonic() + args.warmup
+            await asyncio.gather(*(worker(deadline, False) for _ in range(args.concurrency)))
+
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(*(worker(deadline, True) for _ in range(args.concurrency)))
+        elapsed = time.monotonic() - started
+
+        # чекаємо, поки вихідна черга відправить усе у фейковий Telegram
+        drain_deadline = time.monotonic() + 15
+        while time.monotonic() < drain_deadline:
+            st = (await client.get("/stats")).json()
+            if not st["outbound"]["queue_depth"]:
+                break
+            await asyncio.sleep(0.2)
+
+    return {k: (v, errors.get(k, 0)) for k, v in samples.items()}, elapsed
+
+
+def pct(sorted_vals: list[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    i = min(len(sorted_vals) - 1, max(0, round(p / 100 * len(sorted_vals)) - 1))
+    return sorted_vals[i]
+
+
+def report(results: dict, elapsed: float, counters: dict):
+    total = sum(len(v) for v, _ in results.values())
+    print(f"{total} updates in {elapsed:.1f}s -> {total / elapsed:,.0f} updates/s")
+    print(f"{'intent':<16}{'n':>8}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    everything = []
+    for intent in sorted(results, key=lambda k: -len(results[k][0])):
+        vals, errs = results[intent]
+        vals = sorted(vals)
+        everything.extend(vals)
+        print(f"{intent:<16}{len(vals):>8}{errs:>6}"
+              f"{pct(vals, 50) * 1000:>10.2f}{pct(vals, 95) * 1000:>10.2f}{pct(vals, 99) * 1000:>10.2f}")
+    everything.sort()
+    print(f"{'all':<16}{len(everything):>8}{sum(e for _, e in results.values()):>6}"
+          f"{pct(everything, 50) * 1000:>10.2f}{pct(everything, 95) * 1000:>10.2f}{pct(everything, 99) * 1000:>10.2f}")
+    print("upstream calls:", ", ".join(f"{k}={v}" for k, v in counters.items()))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--duration", type=float, default=20.0)
+    ap.add_argument("--warmup", type=float, default=2.0)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--tg-latency", type=float, default=0.03)
+    ap.add_argument("--tg-error-rate", type=float, default=0.01)
+    ap.add_argument("--owm-latency", type=float, default=0.08)
+    ap.add_argument("--owm-error-rate", type=float, default=0.02)
+    ap.add_argument("--cache-ttl", type=float, default=600, help="WEATHER_CACHE_TTL for the bot; 0 hits OWM every time")
+    ap.add_argument("--quiet", action="store_true", help="hide the bot's own log output")
+    args = ap.parse_args()
+
+    fakes, counters = make_fakes(args)
+    fake_port = free_port()
+    fake_server = serve_in_thread(fakes, fake_port)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bot, bot_url = start_bot(f"http://127.0.0.1:{fake_port}", args, workdir)
+        try:
+            results, elapsed = asyncio.run(run_load(bot_url, args))
+        finally:
+            bot.terminate()
+            bot.wait(timeout=15)
+            fake_server.should_exit = True
+
+    report(results, elapsed, counters)
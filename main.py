@@ -1,74 +1,988 @@
 import os
 import re
+import sys
+import atexit
+import json
+import time
+import uuid
+import queue
+import logging
+import logging.handlers
+import contextvars
+import hmac
+import heapq
+import bisect
+import pickle
+import signal
+import sqlite3
 import random
-import requests
+import socket
+import asyncio
+import inspect
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from contextlib import asynccontextmanager
+
+import httpx
+import orjson
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 
 # ===== ENV =====
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+BOT_MODE = os.getenv("BOT_MODE", "webhook")  # webhook | polling
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
 
-TELEGRAM_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")  # інший хост — для локальних стендів
+TELEGRAM_API = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}"
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "10"))
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_MAX_CONNECTIONS", "100"))
+
+# ліміти Telegram: ~30 msg/s на бота, ~1 msg/s у приватний чат, ~20 msg/хв у групу
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_PRIVATE_RATE = float(os.getenv("OUTBOUND_PRIVATE_RATE", "1"))
+OUTBOUND_GROUP_PER_MIN = float(os.getenv("OUTBOUND_GROUP_PER_MIN", "20"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5"))
+
+# відповідь прямо в тілі відповіді на webhook (економить один HTTP-запит на повідомлення)
+REPLY_IN_RESPONSE = os.getenv("REPLY_IN_RESPONSE", "0") == "1"
+REPLY_INLINE_BUDGET = float(os.getenv("REPLY_INLINE_BUDGET", "0.05"))
+
+# long polling (getUpdates) замість webhook — для стендів без публічного HTTPS
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))
+
+OWM_API = os.getenv("OWM_API", "https://api.openweathermap.org")
+WEATHER_TIMEOUT = float(os.getenv("WEATHER_TIMEOUT", "10"))
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "600"))
+WEATHER_CACHE_MAX_STALE = float(os.getenv("WEATHER_CACHE_MAX_STALE", "3600"))
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "256"))
+# «погода в Києві, Львові та Одесі»: скільки міст беремо з одного запиту і скільки тягнемо паралельно
+WEATHER_MAX_CITIES = int(os.getenv("WEATHER_MAX_CITIES", "5"))
+WEATHER_PARALLEL = int(os.getenv("WEATHER_PARALLEL", "3"))
+# прогноз (/data/2.5/forecast): один запит на місто, з нього «завтра» і «тиждень»
+FORECAST_CACHE_TTL = float(os.getenv("FORECAST_CACHE_TTL", "1800"))
+FORECAST_CACHE_SIZE = int(os.getenv("FORECAST_CACHE_SIZE", "128"))
+FORECAST_DAYS = int(os.getenv("FORECAST_DAYS", "5"))
+
+# запобіжник перед OWM: частка невдалих/повільних викликів у вікні -> пауза на OPEN_FOR секунд
+OWM_BREAKER_FAILURE_RATE = float(os.getenv("OWM_BREAKER_FAILURE_RATE", "0.5"))
+OWM_BREAKER_SLOW_CALL = float(os.getenv("OWM_BREAKER_SLOW_CALL", "3"))
+OWM_BREAKER_WINDOW = int(os.getenv("OWM_BREAKER_WINDOW", "20"))
+OWM_BREAKER_MIN_CALLS = int(os.getenv("OWM_BREAKER_MIN_CALLS", "5"))
+OWM_BREAKER_OPEN_FOR = float(os.getenv("OWM_BREAKER_OPEN_FOR", "30"))
+
+# фонове оновлення погоди для найпопулярніших міст (PREFETCH_TOP_N=0 — вимкнено)
+PREFETCH_TOP_N = int(os.getenv("PREFETCH_TOP_N", "20"))
+PREFETCH_BUDGET_PER_MIN = float(os.getenv("PREFETCH_BUDGET_PER_MIN", "20"))
+PREFETCH_INTERVAL = float(os.getenv("PREFETCH_INTERVAL", "15"))
+PREFETCH_LEAD = float(os.getenv("PREFETCH_LEAD", "60"))  # за скільки секунд до кінця TTL оновлювати
+POPULARITY_HALF_LIFE = float(os.getenv("POPULARITY_HALF_LIFE", "3600"))
+GEOCODE_DB = os.getenv("GEOCODE_DB", "geocode.sqlite3")
+GEOCODE_MISS_TTL = float(os.getenv("GEOCODE_MISS_TTL", str(7 * 24 * 3600)))
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "4096"))
+# кілька воркерів: спільні L2-кеш, dedup, ліміти і один лідер (реєструє webhook / опитує getUpdates)
+SHARED_STATE_DB = os.getenv("SHARED_STATE_DB")
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+PERSONA_SYNC_INTERVAL = float(os.getenv("PERSONA_SYNC_INTERVAL", "5"))  # як часто воркер звіряє версію персони
+WEBHOOK_SETUP_TIMEOUT = float(os.getenv("WEBHOOK_SETUP_TIMEOUT", "5"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # без нього /admin/* вимкнено
+
+# антифлуд: скільки тригер-повідомлень ("нері…", команди, ігри) за ADMISSION_WINDOW секунд; 0 — без ліміту
+ADMISSION_WINDOW = float(os.getenv("ADMISSION_WINDOW", "60"))
+ADMISSION_PRIVATE_PER_CHAT = int(os.getenv("ADMISSION_PRIVATE_PER_CHAT", "20"))
+ADMISSION_GROUP_PER_CHAT = int(os.getenv("ADMISSION_GROUP_PER_CHAT", "30"))
+ADMISSION_GROUP_PER_USER = int(os.getenv("ADMISSION_GROUP_PER_USER", "6"))
+UPDATE_DEDUP_DB = os.getenv("UPDATE_DEDUP_DB") or SHARED_STATE_DB  # спільне вікно для кількох воркерів
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_PAYLOAD_SAMPLE = float(os.getenv("LOG_PAYLOAD_SAMPLE", "0.01"))  # частка повних дампів апдейтів/відповідей
+
+# ===== Logging =====
+# JSON-рядки пише окремий потік: хендлер лише кладе запис у чергу, event loop не чекає на stdout
+_request_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("request_id", default=None)
+
+
+def current_request_id() -> str | None:
+    return _request_id.get()
+
+
+def bind_request_id(rid=None) -> str:
+    rid = str(rid) if rid is not None else uuid.uuid4().hex[:12]
+    _request_id.set(rid)
+    return rid
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "event": record.getMessage(),
+        }
+        if record.rid is not None:
+            entry["rid"] = record.rid
+        entry.update(record.fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=repr)
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # форматування — у потоці listener'а; тут лише знімаємо correlation id з контексту
+        record.rid = _request_id.get()
+        if not hasattr(record, "fields"):
+            record.fields = {}
+        return record
+
+
+def _setup_logging() -> logging.handlers.QueueListener:
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(JsonFormatter())
+    q = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(q, out)
+    logger = logging.getLogger("neri")
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(_ContextQueueHandler(q))
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)  # дописати чергу при виході
+    return listener
+
+
+log = logging.getLogger("neri")
+_log_listener = _setup_logging()
+
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    if log.isEnabledFor(level):
+        log.log(level, event, extra={"fields": fields})
+
+
+def log_sampled() -> bool:
+    return LOG_PAYLOAD_SAMPLE > 0 and random.random() < LOG_PAYLOAD_SAMPLE
+
+# ===== Metrics =====
+# Усе оновлюється з одного event loop, тож лічильникам не потрібні локи:
+# observe() — це bisect і кілька інкрементів у dict/list.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _fmt_labels(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    parts = []
+    for n, v in itertools.chain(zip(names, values), extra):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{n}="{v}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labelvalues, amount: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for lv, v in self._values.items():
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {v}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labelvalues -> [лічильники по бакетах (останній — +Inf), sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labelvalues):
+        s = self._series.get(labelvalues)
+        if s is None:
+            s = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect.bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for lv, (counts, total) in self._series.items():
+            acc = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts):
+                acc += c
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, (('le', le),))} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, lv)} {total}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, lv)} {acc}")
+        return out
+
+
+class CallbackMetric:
+    """Значення знімаються зі stats() компонентів у момент scrape."""
+
+    def __init__(self, name: str, help: str, type: str, labels: tuple, fn):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = labels
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for lv, v in self.fn():
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {v}")
+        return out
+
+
+METRICS: list = []
+
+
+def register(metric):
+    METRICS.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    lines = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+INTENT_REQUESTS = register(Counter("neri_intent_requests_total", "Updates routed, by intent and outcome", ("intent", "outcome")))
+INTENT_LATENCY = register(Histogram("neri_intent_latency_seconds", "Time to produce a reply, by intent", ("intent",)))
+UPSTREAM_REQUESTS = register(Counter("neri_upstream_requests_total", "Upstream HTTP calls, by upstream and status", ("upstream", "status")))
+UPSTREAM_LATENCY = register(Histogram("neri_upstream_latency_seconds", "Upstream HTTP call latency", ("upstream",)))
+
+
+def observe_upstream(upstream: str, status, started: float):
+    UPSTREAM_REQUESTS.inc(upstream, status)
+    UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream)
+
+
+def observe_intent(intent: str | None, outcome: str, started: float):
+    intent = intent or "none"
+    INTENT_REQUESTS.inc(intent, outcome)
+    INTENT_LATENCY.observe(time.perf_counter() - started, intent)
+
+
+# ===== Telegram client =====
+class TelegramClient:
+    """Async клієнт Bot API зі спільним keep-alive пулом з'єднань."""
+
+    def __init__(self, base_url: str, timeout: float = 10.0, max_connections: int = 100):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._http: httpx.AsyncClient | None = None
+
+    async def start(self):
+        if self._http is not None:
+            return
+        self._http = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=60,
+            ),
+        )
+
+    async def close(self):
+        if self._http is None:
+            return
+        await self._http.aclose()
+        self._http = None
+
+    async def call(self, method: str, payload: dict | None = None, timeout: float | None = None) -> dict | None:
+        if self._http is None:
+            await self.start()
+        started = time.perf_counter()
+        try:
+            r = await self._http.post(method, json=payload or {}, timeout=timeout or self.timeout)
+        except Exception as e:
+            observe_upstream(f"telegram.{method}", "error", started)
+            log_event("telegram.error", logging.WARNING, method=method, error=repr(e))
+            return None
+        observe_upstream(f"telegram.{method}", r.status_code, started)
+        try:
+            res = orjson.loads(r.content)
+        except ValueError:
+            res = None
+        ok = bool(res and res.get("ok"))
+        if not ok or log_sampled():
+            log_event("telegram.response", logging.INFO if ok else logging.WARNING,
+                      method=method, status=r.status_code, body=r.text)
+        else:
+            log_event("telegram.response", logging.DEBUG, method=method, status=r.status_code)
+        return res
+
+
+tg = TelegramClient(TELEGRAM_API, timeout=TELEGRAM_TIMEOUT, max_connections=TELEGRAM_MAX_CONNECTIONS)
+
+# ===== Background tasks =====
+_background: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    """create_task, що тримає посилання на задачу, поки вона не завершиться."""
+    t = asyncio.ensure_future(coro)
+    _background.add(t)
+    t.add_done_callback(_background.discard)
+    return t
+
+# ===== SQLite =====
+def open_sqlite(path: str, *schema: str) -> sqlite3.Connection:
+    """З'єднання у WAL-режимі: читачі з різних процесів не блокують одне одного."""
+    conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for stmt in schema:
+        conn.execute(stmt)
+    return conn
+
+
+class SqliteThread:
+    """
+    Окремий потік для з'єднання: під конкуренцією воркерів SQLite чекає на блокування
+    до busy timeout (5 с), і це чекання не має зупиняти event loop.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._executor: ThreadPoolExecutor | None = None
+        self._pid = None
+
+    async def run(self, fn, *args):
+        """fn(*args) у цьому потоці; після fork() — новий потік."""
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+            self._pid = os.getpid()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+# ===== Shared state (кілька воркерів) =====
+class SharedState:
+    """
+    Стан, спільний для всіх воркерів на машині: SQLite у WAL-режимі.
+    kv — L2-кеш із TTL, leases — оренди (лідер, "я вже качаю це місто"),
+    buckets — token bucket'и вихідних лімітів Telegram.
+    Методи синхронні; з event loop їх кличуть через run() — в окремому потоці,
+    бо під конкуренцією воркерів SQLite чекає на блокування до busy timeout (5 с).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.owner = ""
+        self._conn: sqlite3.Connection | None = None
+        self._pid = None
+        self._ops = 0
+        self._thread = SqliteThread("shared-state")
+
+    async def run(self, fn, *args):
+        """fn(*args) у потоці SharedState — з'єднання живе тільки в ньому."""
+        return await self._thread.run(fn, *args)
+
+    def _db(self) -> sqlite3.Connection:
+        # після fork() з'єднання батька використовувати не можна
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = open_sqlite(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "ts REAL NOT NULL, expires REAL NOT NULL, PRIMARY KEY (ns, key))",
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)",
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, ts REAL NOT NULL)",
+            )
+            self._pid = os.getpid()
+            self.owner = f"{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:6]}"
+        return self._conn
+
+    # --- L2-кеш ---
+    def get(self, ns: str, key: str) -> tuple[object, float] | None:
+        """(значення, вік у секундах) або None."""
+        now = time.time()
+        row = self._db().execute(
+            "SELECT value, ts FROM kv WHERE ns = ? AND key = ? AND expires > ?", (ns, key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), max(0.0, now - row[1])
+
+    def put(self, ns: str, key: str, value, ttl: float):
+        now = time.time()
+        db = self._db()
+        db.execute(
+            "INSERT OR REPLACE INTO kv (ns, key, value, ts, expires) VALUES (?, ?, ?, ?, ?)",
+            (ns, key, json.dumps(value, ensure_ascii=False), now, now + ttl),
+        )
+        self._ops += 1
+        if self._ops % 256 == 0:
+            db.execute("DELETE FROM kv WHERE expires <= ?", (now,))
+            db.execute("DELETE FROM buckets WHERE ts < ?", (now - 3600,))
+
+    # --- оренди ---
+    def acquire(self, name: str, ttl: float) -> bool:
+        """Взяти або продовжити оренду. False — її тримає інший живий процес."""
+        now = time.time()
+        db = self._db()
+        cur = db.execute(
+            "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+            "WHERE leases.owner = excluded.owner OR leases.expires <= ?",
+            (name, self.owner, now + ttl, now),
+        )
+        return cur.rowcount == 1
+
+    def release(self, name: str):
+        db = self._db()
+        db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+
+    # --- лічильники лімітів ---
+    def bucket(self, key: str, rate: float, capacity: float) -> "SharedTokenBucket":
+        return SharedTokenBucket(self, key, rate, capacity)
+
+    def take(self, *buckets: "SharedTokenBucket") -> float:
+        """
+        По токену з кожного bucket'а однією транзакцією: 0 — списано з усіх,
+        інакше скільки чекати, і тоді не списано нічого.
+        """
+        db = self._db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            levels = [b._tokens(db, now) for b in buckets]
+            wait = max([(1 - t) / b.rate for b, t in zip(buckets, levels) if t < 1], default=0.0)
+            if wait <= 0:
+                db.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, ts) VALUES (?, ?, ?)",
+                    [(b.key, t - 1, now) for b, t in zip(buckets, levels)],
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class SharedTokenBucket:
+    """
+    Token bucket, токени якого лежать у SharedState — ліміт спільний для всіх воркерів.
+    Списує лише SharedState.take(): перевірка і списання в одній транзакції, інакше двоє
+    воркерів заберуть той самий останній токен. Час — time.time(): monotonic у різних
+    процесах не порівнюється, тож `now` ігнорується.
+    """
+
+    def __init__(self, state: SharedState, key: str, rate: float, capacity: float):
+        self.state = state
+        self.key = key
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+
+    def _tokens(self, db: sqlite3.Connection, now: float) -> float:
+        row = db.execute("SELECT tokens, ts FROM buckets WHERE key = ?", (self.key,)).fetchone()
+        if row is None:
+            return self.capacity
+        tokens, ts = row
+        return min(self.capacity, tokens + max(0.0, now - ts) * self.rate)
+
+    def idle(self, now: float) -> bool:
+        return self._tokens(self.state._db(), time.time()) >= self.capacity
+
+
+shared_state = SharedState(SHARED_STATE_DB) if SHARED_STATE_DB else None
+
+
+# ===== Outbound dispatcher (flood limits) =====
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.ts = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.ts:
+            self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+
+    def delay(self, now: float) -> float:
+        """Скільки секунд чекати до наступного токена (0 — можна зараз)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
 
-app = FastAPI()
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+def local_bucket(key: str, rate: float, capacity: float) -> TokenBucket:
+    return TokenBucket(rate, capacity)
+
+
+def _take_tokens(bucket: TokenBucket, glob: TokenBucket, now: float) -> float:
+    """По токену з чату і з глобального; 0 — списано, інакше скільки ще чекати."""
+    wait = max(bucket.delay(now), glob.delay(now))
+    if wait <= 0:
+        bucket.consume(now)
+        glob.consume(now)
+    return wait
+
+
+class OutboundDispatcher:
+    """
+    Черга вихідних повідомлень перед Bot API.
+    Token bucket на весь бот + окремий на кожен чат, 429 -> пауза чату на retry_after.
+    Порядок повідомлень у межах одного чату зберігається.
+    Зі спільним станом bucket'и лежать у SQLite, і кожна операція з ними йде через shared.run().
+    """
+
+    def __init__(self, client: TelegramClient, global_rate: float, private_rate: float,
+                 group_rate: float, chat_burst: float, max_attempts: int = 5,
+                 shared: SharedState | None = None):
+        self._client = client
+        self._shared = shared
+        self._new_bucket = shared.bucket if shared is not None else local_bucket
+        self._global = self._new_bucket("global", global_rate, global_rate)
+        self._private_rate = private_rate
+        self._group_rate = group_rate
+        self._chat_burst = chat_burst
+        self._max_attempts = max_attempts
+
+        self._queues: dict[int, deque] = {}
+        self._buckets: dict[int, TokenBucket] = {}
+        self._blocked_until: dict[int, float] = {}
+        self._busy: set[int] = set()
+        self._heap: list[tuple[float, int, int]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._deliveries: set[asyncio.Task] = set()
+        self._last_prune = time.monotonic()
+
+        self.depth = 0
+        self.sent = 0
+        self.inline = 0
+        self.retried_429 = 0
+        self.dropped = 0
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self._buckets.get(chat_id)
+        if b is None:
+            rate = self._group_rate if chat_id < 0 else self._private_rate
+            b = self._buckets[chat_id] = self._new_bucket(f"chat:{chat_id}", rate, self._chat_burst)
+        return b
+
+    def _push(self, chat_id: int, when: float):
+        heapq.heappush(self._heap, (when, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    def submit(self, chat_id: int, payload: dict):
+        q = self._queues.get(chat_id)
+        if q is None:
+            q = self._queues[chat_id] = deque()
+        q.append([payload, 0, current_request_id()])
+        self.depth += 1
+        # чат стоїть у heap рівно один раз, поки в нього є черга і нічого не летить
+        if len(q) == 1 and chat_id not in self._busy:
+            self._push(chat_id, time.monotonic())
+
+    async def _take(self, bucket, now: float) -> float:
+        if self._shared is None:
+            return _take_tokens(bucket, self._global, now)
+        return await self._shared.run(self._shared.take, bucket, self._global)
+
+    async def try_acquire(self, chat_id: int) -> bool:
+        """
+        Чи можна відповісти в цей чат просто зараз, повз чергу (у тілі webhook-відповіді).
+        Якщо так — токени вже списано.
+        """
+        if chat_id in self._queues or chat_id in self._busy:
+            return False
+        now = time.monotonic()
+        if self._blocked_until.get(chat_id, 0.0) > now:
+            return False
+        if await self._take(self._bucket(chat_id), now) > 0:
+            return False
+        self.inline += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth,
+            "chats_waiting": len(self._queues),
+            "in_flight": len(self._busy),
+            "sent": self.sent,
+            "inline": self.inline,
+            "retried_429": self.retried_429,
+            "dropped": self.dropped,
+        }
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self, drain_timeout: float = 5.0):
+        deadline = time.monotonic() + drain_timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.depth:
+            log_event("outbound.lost_on_shutdown", logging.WARNING, depth=self.depth)
+
+    async def _sleep_until(self, when: float):
+        self._wakeup.clear()
+        timeout = None if when is None else max(0.0, when - time.monotonic())
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._sleep_until(None)
+                continue
+
+            when, _, chat_id = self._heap[0]
+            now = time.monotonic()
+            if when > now:
+                await self._sleep_until(when)
+                continue
+            heapq.heappop(self._heap)
+
+            wait = self._blocked_until.get(chat_id, 0.0) - now
+            if wait <= 0:
+                wait = await self._take(self._bucket(chat_id), now)
+            if wait > 0:
+                self._push(chat_id, now + wait)
+                continue
+
+            item = self._queues[chat_id].popleft()
+            self._busy.add(chat_id)
+            t = asyncio.create_task(self._deliver(chat_id, item))
+            self._deliveries.add(t)
+            t.add_done_callback(self._deliveries.discard)
+
+            if now - self._last_prune > 60:
+                await self._prune(now)
+
+    async def _deliver(self, chat_id: int, item: list):
+        payload, attempts, rid = item
+        _request_id.set(rid)  # лог доставки — з id апдейту, що породив відповідь
+        res = await self._client.call("sendMessage", payload)
+        now = time.monotonic()
+        retry_after = None
+
+        if res is None:
+            # мережа/таймаут — пробуємо ще кілька разів з backoff
+            item[1] = attempts + 1
+            if item[1] < self._max_attempts:
+                retry_after = min(30.0, 0.5 * 2 ** attempts)
+        elif not res.get("ok"):
+            if res.get("error_code") == 429:
+                params = res.get("parameters") or {}
+                retry_after = float(params.get("retry_after") or 1)
+                self.retried_429 += 1
+
+        q = self._queues[chat_id]
+        if retry_after is not None:
+            self._blocked_until[chat_id] = now + retry_after
+            q.appendleft(item)
+        else:
+            self.depth -= 1
+            if res is not None and res.get("ok"):
+                self.sent += 1
+            else:
+                self.dropped += 1
+                log_event("outbound.dropped", logging.WARNING, chat_id=chat_id, response=res)
+
+        self._busy.discard(chat_id)
+        if q:
+            self._push(chat_id, max(now, self._blocked_until.get(chat_id, 0.0)))
+        else:
+            del self._queues[chat_id]
+
+    async def _prune(self, now: float):
+        self._last_prune = now
+        candidates = [(c, b) for c, b in self._buckets.items() if c not in self._queues]
+        if self._shared is None:
+            idle = [c for c, b in candidates if b.idle(now)]
+        else:
+            idle = await self._shared.run(lambda: [c for c, b in candidates if b.idle(now)])
+        for chat_id in idle:
+            if chat_id not in self._queues:
+                self._buckets.pop(chat_id, None)
+        for chat_id in [c for c, t in self._blocked_until.items() if t <= now]:
+            del self._blocked_until[chat_id]
+
+
+dispatcher = OutboundDispatcher(
+    tg,
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    private_rate=OUTBOUND_PRIVATE_RATE,
+    group_rate=OUTBOUND_GROUP_PER_MIN / 60,
+    chat_burst=OUTBOUND_CHAT_BURST,
+    max_attempts=OUTBOUND_MAX_ATTEMPTS,
+    shared=shared_state,
+)
 
 # ===== Telegram helpers =====
 def send_message(chat_id: int, text: str):
-    url = f"{TELEGRAM_API}/sendMessage"
-    payload = {"chat_id": chat_id, "text": text}
-    try:
-        r = requests.post(url, json=payload, timeout=10)
-        print("sendMessage status:", r.status_code)
-        print("sendMessage response:", r.text)
-    except Exception as e:
-        print("sendMessage error:", repr(e))
+    dispatcher.submit(chat_id, {"chat_id": chat_id, "text": text})
+
+
+# стан для /ready; webhook: pending | ok | failed | disabled | not_leader
+READINESS = {"serving": False, "webhook": "pending"}
+
+
+# інші типи апдейтів бот ігнорує — хай Telegram їх і не шле (webhook і getUpdates)
+ALLOWED_UPDATES = ["message"]
 
+def webhook_settings() -> dict:
+    """Параметри setWebhook; getWebhookInfo повертає їх під тими ж ключами."""
+    return {"url": WEBHOOK_URL, "allowed_updates": ALLOWED_UPDATES}
 
-def set_webhook():
-    url = f"{TELEGRAM_API}/setWebhook"
-    payload = {"url": WEBHOOK_URL, "drop_pending_updates": True}
-    r = requests.post(url, json=payload)
-    print("Webhook set:", r.text)
+
+async def set_webhook() -> bool:
+    """
+    Реєструє webhook лише якщо в Telegram інша адреса чи налаштування.
+    Апдейти, що чекають у черзі Telegram, не відкидаємо — це живі повідомлення.
+    """
+    want = webhook_settings()
+    info = await tg.call("getWebhookInfo", timeout=WEBHOOK_SETUP_TIMEOUT)
+    if info is None or not info.get("ok"):
+        return False
+    current = info.get("result") or {}
+    if all(current.get(k) == v for k, v in want.items()):
+        log_event("webhook.unchanged", url=WEBHOOK_URL, pending=current.get("pending_update_count"))
+        return True
+    res = await tg.call("setWebhook", want, timeout=WEBHOOK_SETUP_TIMEOUT)
+    log_event("webhook.set", response=res)
+    return bool(res and res.get("ok"))
+
+
+async def register_webhook():
+    """Фоном і з повторами: повільний чи недоступний Telegram не тримає старт."""
+    if not WEBHOOK_URL:
+        READINESS["webhook"] = "disabled"
+        return
+    delay = 1.0
+    while True:
+        if await set_webhook():
+            READINESS["webhook"] = "ok"
+            return
+        READINESS["webhook"] = "failed"
+        await asyncio.sleep(delay)
+        delay = min(60.0, delay * 2)
+
+
+async def _on_elected():
+    if BOT_MODE == "polling":
+        READINESS["webhook"] = "disabled"
+        await polling_runner.start()
+    else:
+        spawn(register_webhook())
+
+
+async def run_leader():
+    """
+    Webhook реєструє (або getUpdates опитує) рівно один процес — власник оренди "leader".
+    Без SHARED_STATE_DB процес один, тож він і є лідером.
+    """
+    if shared_state is None:
+        await _on_elected()
+        return
+    elected = False
+    while True:
+        try:
+            won = await shared_state.run(shared_state.acquire, "leader", LEADER_LEASE_TTL)
+        except sqlite3.Error as e:
+            log_event("leader.error", logging.WARNING, error=repr(e))
+            won = False
+        if won and not elected:
+            elected = True
+            log_event("leader.elected", owner=shared_state.owner)
+            await _on_elected()
+        elif not won and not elected:
+            READINESS["webhook"] = "not_leader"
+        elif not won and elected:
+            elected = False
+            log_event("leader.lost", owner=shared_state.owner)
+            await polling_runner.close()
+        await asyncio.sleep(LEADER_LEASE_TTL / 3)
 
 
 # ===== Startup =====
-@app.on_event("startup")
-async def startup():
-    print("Starting up...")
-    print("BOT_TOKEN exists:", bool(BOT_TOKEN))
-    print("WEBHOOK_URL:", WEBHOOK_URL)
-    print("WEATHER_API_KEY exists:", bool(WEATHER_API_KEY))
-    set_webhook()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_event(
+        "startup",
+        bot_token=bool(BOT_TOKEN),
+        mode=BOT_MODE,
+        webhook_url=WEBHOOK_URL,
+        weather_api_key=bool(WEATHER_API_KEY),
+    )
+    await tg.start()
+    await dispatcher.start()
+    leader = asyncio.create_task(run_leader())
+    prefetch = asyncio.create_task(prefetch_loop())
+    persona_sync = asyncio.create_task(watch_persona())
+    loop = asyncio.get_running_loop()
+    try:
+        # kill -HUP <pid> — перечитати пакет персони без рестарту; з SHARED_STATE_DB
+        # решта воркерів підхопить його за PERSONA_SYNC_INTERVAL
+        loop.add_signal_handler(signal.SIGHUP, lambda: spawn(_reload_persona_logged()))
+        hup = True
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        hup = False
+    READINESS["serving"] = True
+    try:
+        yield
+    finally:
+        READINESS["serving"] = False
+        if hup:
+            loop.remove_signal_handler(signal.SIGHUP)
+        leader.cancel()
+        prefetch.cancel()
+        persona_sync.cancel()
+        await polling_runner.close()
+        if shared_state is not None:
+            await shared_state.run(shared_state.release, "leader")
+        await dispatcher.close()
+        await tg.close()
+        await close_owm_http()
 
 
-# ===== Weather =====
-CITY_ALIASES = {
-    "києві": "київ", "києва": "київ", "київ": "київ",
-    "львові": "львів", "львова": "львів", "львів": "львів",
-    "одесі": "одеса", "одеси": "одеса", "одеса": "одеса",
-    "харкові": "харків", "харкова": "харків", "харків": "харків",
-    "дніпрі": "дніпро", "дніпра": "дніпро", "дніпро": "дніпро",
-    "запоріжжі": "запоріжжя", "запоріжжя": "запоріжжя",
-}
+app = FastAPI(lifespan=lifespan)
 
-CITY_LATIN = {
-    "київ": "Kyiv",
-    "львів": "Lviv",
-    "одеса": "Odesa",
-    "харків": "Kharkiv",
-    "дніпро": "Dnipro",
-    "запоріжжя": "Zaporizhzhia",
-}
 
+# ===== Weather =====
 WEATHER_STOPWORDS = {
     "погода", "яка", "яке", "який", "зараз", "сьогодні", "будь", "ласка",
     "покажи", "скажи", "напиши", "негайно", "будь-ласка", "пліз", "плиз",
     "у", "в", "на", "по", "для", "місті", "місто", "про",
-    "нері"
+    "нері", "а", "ну", "ти", "як", "що", "дякую", "дякі", "спасибі",
+    "завтра", "тиждень", "тижня", "тижні", "наступний", "наступного", "прогноз", "прогнозу", "погоди",
 }
 
+# ===== Gazetteer =====
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ua_cities.tsv")
+
+class CityTrie:
+    """
+    Префіксне дерево над формами назв міст (посимвольно).
+    Пошук іде за довжиною запиту і не залежить від кількості міст у газетирі.
+    """
+
+    _END = ""
+
+    def __init__(self):
+        self._root: dict = {}
+
+    def add(self, form: str, city: str):
+        node = self._root
+        for ch in form:
+            node = node.setdefault(ch, {})
+        node[self._END] = city
+
+    @staticmethod
+    def _is_word_char(ch: str) -> bool:
+        return ch.isalnum() or ch in "'-"
+
+    def find_all(self, text: str) -> list[tuple[int, int, str]]:
+        """Усі найдовші збіги цілими словами: (start, end, city)."""
+        out = []
+        i, n = 0, len(text)
+        while i < n:
+            if i > 0 and self._is_word_char(text[i - 1]):
+                i += 1
+                continue
+            node = self._root
+            best = None
+            j = i
+            while j < n and text[j] in node:
+                node = node[text[j]]
+                j += 1
+                if self._END in node and (j == n or not self._is_word_char(text[j])):
+                    best = (i, j, node[self._END])
+            if best:
+                out.append(best)
+                i = best[1]
+            else:
+                i += 1
+        return out
+
+
+def _norm_place(s: str) -> str:
+    return (s or "").lower().replace("’", "'").replace("ʼ", "'")
+
+def load_gazetteer(path: str) -> tuple[dict[str, dict], dict[str, str], CityTrie]:
+    places: dict[str, dict] = {}
+    forms: dict[str, str] = {}
+    trie = CityTrie()
+    if not os.path.exists(path):
+        log_event("gazetteer.missing", logging.WARNING, path=path)
+        return places, forms, trie
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            name, latin, lat, lon, raw_forms = line.split("\t")
+            key = _norm_place(name)
+            places[key] = {"uk": name, "latin": latin, "lat": float(lat), "lon": float(lon)}
+            for form in [key] + raw_forms.split(","):
+                form = _norm_place(form.strip())
+                if form:
+                    forms[form] = key
+                    trie.add(form, key)
+    return places, forms, trie
+
+
+GAZETTEER, GAZETTEER_FORMS, CITY_TRIE = load_gazetteer(GAZETTEER_PATH)
+
+def gazetteer_geo(city_norm: str) -> dict | None:
+    """Готова відповідь у форматі геокодера OWM — без мережі."""
+    place = GAZETTEER.get(city_norm)
+    if not place:
+        return None
+    return {
+        "name": place["latin"],
+        "lat": place["lat"],
+        "lon": place["lon"],
+        "country": "UA",
+        "local_names": {"uk": place["uk"]},
+    }
+
 def extract_city_from_query(q: str) -> str | None:
+    found = CITY_TRIE.find_all(_norm_place(q))
+    if found:
+        return found[-1][2]
+
     s = re.sub(r"[^\w\s\-’ʼіїєґа-яА-Я]", " ", q, flags=re.UNICODE).strip().lower()
     parts = [p for p in s.split() if p and p not in WEATHER_STOPWORDS]
     if not parts:
@@ -79,15 +993,69 @@ def extract_city_from_query(q: str) -> str | None:
             return last2
     return parts[-1]
 
+_CITY_SEP_RE = re.compile(r"\s*[,;]\s*|\s+(?:та|і|й)\s+")
+_CITY_PREP_RE = re.compile(r"\b(?:в|у)\s+(.+)")
+# дієслівні закінчення: «дякую», «вдягнути», «здається» — не назви місць
+_NOT_PLACE_ENDINGS = ("ую", "юю", "ти", "ть", "ся", "сь")
+# місцевий відмінок після «в/у»: «Варшаві», «Берліні», «Жмеринці»
+_LOCATIVE_ENDINGS = ("і", "ї", "у", "ю")
+
+def _place_guess(text: str, locative: bool = False) -> str | None:
+    """Місто з уламка без збігу в газетирі або None, якщо уламок схожий на балачку."""
+    city = extract_city_from_query(text)
+    if not city:
+        return None
+    words = city.split()
+    if any(len(w) < 3 or not w.replace("-", "").replace("'", "").isalpha() or w.endswith(_NOT_PLACE_ENDINGS)
+           for w in words):
+        return None
+    if locative and not words[-1].endswith(_LOCATIVE_ENDINGS):
+        return None
+    return city
+
+def extract_cities_from_query(q: str) -> list[str]:
+    """
+    Усі міста із запиту — у порядку згадки, без повторів (за normalize_city), не більше WEATHER_MAX_CITIES.
+    Кожна частина (через кому, «і», «та», «й») — окремо: збіг у газетирі, інакше здогадка
+    після «в/у». Частина без прийменника — місто, лише якщо це перша частина («погода рахів»)
+    або продовження переліку в місцевому відмінку («в Києві та Варшаві»).
+    """
+    found = []
+    for i, part in enumerate(_CITY_SEP_RE.split(q)):
+        hits = [city for _, _, city in CITY_TRIE.find_all(_norm_place(part))]
+        if hits:
+            found.extend(hits)
+            continue
+        m = _CITY_PREP_RE.search(part)
+        if m:
+            city = _place_guess(m.group(1))
+        elif i == 0:
+            city = _place_guess(part)
+        elif found:
+            city = _place_guess(part, locative=True)
+        else:
+            city = None
+        if city:
+            found.append(city)
+
+    out, seen = [], set()
+    for city in found:
+        key = normalize_city(city)
+        if key not in seen:
+            seen.add(key)
+            out.append(city)
+    return out[:WEATHER_MAX_CITIES]
+
 def normalize_city(city: str) -> str:
     c = city.strip().lower()
-    if c in CITY_ALIASES:
-        return CITY_ALIASES[c]
+    known = GAZETTEER_FORMS.get(_norm_place(c))
+    if known:
+        return known
 
     for suffix, repl in [("ові", ""), ("еві", ""), ("і", "а"), ("у", "а"), ("ї", "я")]:
         if len(c) > 4 and c.endswith(suffix):
             guess = c[:-len(suffix)] + repl
-            return CITY_ALIASES.get(guess, guess)
+            return GAZETTEER_FORMS.get(guess, guess)
 
     return c
 
@@ -108,79 +1076,761 @@ def weather_emoji(main: str) -> str:
     return "🌿"
 
 def _geocode_candidates(city_norm: str) -> list[str]:
-    lat = CITY_LATIN.get(city_norm)
-    cands = [f"{city_norm},UA", city_norm]
-    if lat:
-        cands += [f"{lat},UA", lat]
-    return cands
-
-def _try_geocode(q: str):
-    geo_url = "https://api.openweathermap.org/geo/1.0/direct"
+    # міста з газетира сюди не доходять — геокодимо лише невідомі назви
+    return [f"{city_norm},UA", city_norm]
+
+# ===== Circuit breaker =====
+class UpstreamError(Exception):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    closed -> open, коли серед останніх `window` викликів частка невдалих або повільних
+    (довше за slow_call) сягає failure_rate. Через open_for — half-open: пропускаємо
+    один пробний виклик; успіх закриває запобіжник, невдача — знову open.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failure_rate: float = 0.5, slow_call: float = 3.0,
+                 window: int = 20, min_calls: int = 5, open_for: float = 30.0):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.min_calls = min_calls
+        self.open_for = open_for
+        self.state = self.CLOSED
+        self._calls: deque = deque(maxlen=window)
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe = False
+        self.opened = 0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_for:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe = False
+        # half-open: рівно один пробний виклик за раз
+        if self._probe:
+            return False
+        self._probe = True
+        return True
+
+    def record(self, ok: bool, duration: float):
+        bad = not ok or duration > self.slow_call
+        if self.state == self.HALF_OPEN:
+            self._probe = False
+            if bad:
+                self._trip()
+            else:
+                self.state = self.CLOSED
+                self._calls.clear()
+                self._failures = 0
+                log_event("circuit.closed", upstream=self.name)
+            return
+        if len(self._calls) == self._calls.maxlen:
+            self._failures -= self._calls[0]
+        self._calls.append(bad)
+        self._failures += bad
+        if (self.state == self.CLOSED and len(self._calls) >= self.min_calls
+                and self._failures >= self.failure_rate * len(self._calls)):
+            self._trip()
+
+    def cancel(self):
+        """Виклик скасували до відповіді: результату немає, але пробу треба звільнити."""
+        if self.state == self.HALF_OPEN:
+            self._probe = False
+
+    def _trip(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self.opened += 1
+        log_event("circuit.open", logging.WARNING, upstream=self.name, open_for=self.open_for)
+
+    def stats(self) -> dict:
+        return {
+            "state": ("closed", "half_open", "open")[self.state],
+            "recent_calls": len(self._calls),
+            "recent_failures": self._failures,
+            "opened": self.opened,
+        }
+
+
+def _owm_breaker(name: str) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        failure_rate=OWM_BREAKER_FAILURE_RATE,
+        slow_call=OWM_BREAKER_SLOW_CALL,
+        window=OWM_BREAKER_WINDOW,
+        min_calls=OWM_BREAKER_MIN_CALLS,
+        open_for=OWM_BREAKER_OPEN_FOR,
+    )
+
+
+owm_breakers = {name: _owm_breaker(name) for name in ("geocode", "weather", "forecast")}
+CIRCUIT_REJECTED = register(Counter("neri_circuit_rejected_total", "Upstream calls refused by an open circuit", ("upstream",)))
+register(CallbackMetric(
+    "neri_circuit_state", "Circuit state: 0 closed, 1 half-open, 2 open", "gauge", ("upstream",),
+    lambda: [((name,), b.state) for name, b in owm_breakers.items()],
+))
+
+# ===== OpenWeatherMap =====
+_owm_http: httpx.AsyncClient | None = None
+
+def owm_http() -> httpx.AsyncClient:
+    global _owm_http
+    if _owm_http is None:
+        _owm_http = httpx.AsyncClient(
+            base_url=OWM_API,
+            timeout=WEATHER_TIMEOUT,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+        )
+    return _owm_http
+
+async def close_owm_http():
+    global _owm_http
+    if _owm_http is not None:
+        await _owm_http.aclose()
+        _owm_http = None
+
+async def owm_get(upstream: str, path: str, params: dict) -> httpx.Response:
+    """GET в OWM через запобіжник; 5xx/429 — помилка upstream'а, а не відповідь."""
+    breaker = owm_breakers[upstream]
+    if not breaker.allow():
+        CIRCUIT_REJECTED.inc(upstream)
+        raise CircuitOpenError(upstream)
+    started = time.perf_counter()
+    try:
+        r = await owm_http().get(path, params=params)
+    except asyncio.CancelledError:
+        # singleflight і _resolve_geo скасовують зайві запити — це не збій upstream'а
+        breaker.cancel()
+        raise
+    except Exception:
+        observe_upstream(upstream, "error", started)
+        breaker.record(False, time.perf_counter() - started)
+        raise
+    observe_upstream(upstream, r.status_code, started)
+    failed = r.status_code >= 500 or r.status_code == 429
+    breaker.record(not failed, time.perf_counter() - started)
+    if failed:
+        raise UpstreamError(f"{upstream}: HTTP {r.status_code}")
+    return r
+
+# ===== Single-flight =====
+class SingleFlight:
+    """
+    Конкурентні виклики з тим самим ключем ділять один upstream-запит.
+    Запит скасовується, лише коли від нього відмовились усі, хто чекав.
+    """
+
+    def __init__(self):
+        self._inflight: dict[str, list] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn, *args):
+        entry = self._inflight.get(key)
+        if entry is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn(*args))
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+        else:
+            self.coalesced += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not task.done():
+                # прибираємо одразу: хто прийде до done-callback'а, не має приєднатися до скасованого запиту
+                task.cancel()
+                self._forget(key, task)
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _forget(self, key: str, task: asyncio.Task):
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._inflight)}
+
+
+geocode_flight = SingleFlight()
+weather_flight = SingleFlight()
+
+# ===== Geocode store =====
+_UNKNOWN = object()
+
+class GeocodeStore:
+    """
+    Дисковий кеш геокодингу: рядок-кандидат -> результат або промах.
+    SQLite у WAL-режимі, тож кілька воркерів можуть читати одночасно.
+    """
+
+    def __init__(self, path: str, miss_ttl: float):
+        self.path = path
+        self.miss_ttl = miss_ttl
+        self._conn: sqlite3.Connection | None = None
+        self._pid = None
+        self._thread = SqliteThread("geocode-store")
+        self.hits = 0
+        self.misses = 0
+
+    async def run(self, fn, *args):
+        """get/put з event loop — через потік сховища."""
+        return await self._thread.run(fn, *args)
+
+    def _db(self) -> sqlite3.Connection:
+        # після fork() з'єднання батька використовувати не можна
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = open_sqlite(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS geocode ("
+                "q TEXT PRIMARY KEY, data TEXT, ts REAL NOT NULL)",
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, q: str):
+        """dict — знайдено, None — відомий промах, _UNKNOWN — ще не питали."""
+        row = self._db().execute("SELECT data, ts FROM geocode WHERE q = ?", (q,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return _UNKNOWN
+        data, ts = row
+        if data is None and time.time() - ts > self.miss_ttl:
+            self.misses += 1
+            return _UNKNOWN
+        self.hits += 1
+        return json.loads(data) if data is not None else None
+
+    def put(self, q: str, geo: dict | None):
+        data = None
+        if geo is not None:
+            data = json.dumps({
+                "name": geo.get("name"),
+                "lat": geo["lat"],
+                "lon": geo["lon"],
+                "country": geo.get("country"),
+                "local_names": {"uk": (geo.get("local_names") or {}).get("uk")},
+            }, ensure_ascii=False)
+        self._db().execute(
+            "INSERT OR REPLACE INTO geocode (q, data, ts) VALUES (?, ?, ?)",
+            (q, data, time.time()),
+        )
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+geocode_store = GeocodeStore(GEOCODE_DB, GEOCODE_MISS_TTL)
+
+async def _geocode_remote(q: str):
+    return await geocode_flight.do(q, _geocode_request, q)
+
+async def _geocode_request(q: str):
     params = {"q": q, "limit": 5, "appid": WEATHER_API_KEY}
-    gr = requests.get(geo_url, params=params, timeout=10)
-    print("GEOCODE TRY:", q, gr.status_code)
+    gr = await owm_get("geocode", "/geo/1.0/direct", params)
+    log_event("geocode.response", q=q, status=gr.status_code)
 
     if gr.status_code != 200:
         return None
 
     arr = gr.json()
     if not arr:
+        await geocode_store.run(geocode_store.put, q, None)
         return None
 
     ua = [x for x in arr if x.get("country") == "UA"]
-    return ua[0] if ua else arr[0]
+    geo = ua[0] if ua else arr[0]
+    await geocode_store.run(geocode_store.put, q, geo)
+    return geo
 
-def get_weather(city_raw: str) -> str:
+async def _resolve_geo(city_norm: str):
+    """
+    Невідомі кандидати геокодяться одночасно. Перемагає перший UA-збіг у порядку
+    пріоритету кандидатів, решта запитів скасовується.
+    """
+    cands = _geocode_candidates(city_norm)
+    results: list = []
+    for c in cands:
+        known = await geocode_store.run(geocode_store.get, c)
+        results.append(known)
+        # далі по списку йти немає сенсу — кращого збігу вже не буде
+        if isinstance(known, dict) and known.get("country") == "UA":
+            break
+
+    tasks = {
+        i: asyncio.ensure_future(_geocode_remote(c))
+        for i, c in enumerate(cands[:len(results)])
+        if results[i] is _UNKNOWN
+    }
+    fallback = None
+    error = None
+    try:
+        for i, known in enumerate(results):
+            if i in tasks:
+                try:
+                    geo = await tasks[i]
+                except Exception as e:
+                    error = error or e
+                    continue
+            else:
+                geo = known
+            if not geo:
+                continue
+            if geo.get("country") == "UA":
+                return geo
+            fallback = fallback or geo
+    finally:
+        for t in tasks.values():
+            t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    if fallback is None and error is not None:
+        raise error
+    return fallback
+
+async def _locate(city_norm: str, city_raw: str) -> tuple[dict, str] | None:
+    """(geo, назва для відповіді) або None, якщо місто не знайшлося."""
+    geo = gazetteer_geo(city_norm) or await _resolve_geo(city_norm)
+    if not geo:
+        return None
+    nice_name = (
+        geo.get("local_names", {}).get("uk")
+        or geo.get("name")
+        or city_raw
+    )
+    return geo, nice_name
+
+async def _fetch_reading(city_norm: str, city_raw: str) -> dict | str:
+    """Повертає показання погоди (dict) або готовий текст помилки."""
+    place = await _locate(city_norm, city_raw)
+    if not place:
+        return f"Не можу знайти погоду для «{city_raw}» 🌿 Спробуй інше місто."
+    geo, nice_name = place
+
+    w_params = {
+        "lat": geo["lat"],
+        "lon": geo["lon"],
+        "appid": WEATHER_API_KEY,
+        "units": "metric",
+        "lang": "uk",
+    }
+    wr = await owm_get("weather", "/data/2.5/weather", w_params)
+    log_event("weather.response", city=city_norm, status=wr.status_code)
+
+    if wr.status_code != 200:
+        return f"Щось не так з погодою для «{nice_name}» 🌿"
+
+    w = wr.json()
+    return {
+        "name": nice_name,
+        "temp": round(w["main"]["temp"]),
+        "feels": round(w["main"]["feels_like"]),
+        "desc": w["weather"][0].get("description", ""),
+        "main": w["weather"][0].get("main", ""),
+    }
+
+def format_weather(r: dict) -> str:
+    em = weather_emoji(r["main"])
+    return f"{em} {r['name']}: {r['temp']}°C (відчувається як {r['feels']}°C), {r['desc']} 🌿"
+
+# ===== Weather cache =====
+class WeatherCache:
+    """
+    LRU + TTL кеш показань за normalize_city.
+    Запис старший за ttl ще віддається (stale-while-revalidate), поки не мине max_stale.
+    Старіші записи get() не віддає, але вони лишаються для last() — запасу на час збою OWM.
+    """
+
+    def __init__(self, ttl: float, max_stale: float, max_size: int):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_size = max_size
+        self._data: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> tuple[dict, bool] | None:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        ts, value = item
+        age = time.monotonic() - ts
+        if age > self.ttl + self.max_stale:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        fresh = age <= self.ttl
+        if fresh:
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+        return value, fresh
+
+    def last(self, key: str) -> tuple[dict, float] | None:
+        """Останнє відоме показання і його вік, хоч яке старе."""
+        item = self._data.get(key)
+        if item is None:
+            return None
+        return item[1], time.monotonic() - item[0]
+
+    def put(self, key: str, value: dict, age: float = 0.0):
+        self._data[key] = (time.monotonic() - age, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+        }
+
+
+weather_cache = WeatherCache(WEATHER_CACHE_TTL, WEATHER_CACHE_MAX_STALE, WEATHER_CACHE_SIZE)
+_weather_refreshing: set[str] = set()
+
+async def _shared_weather(city_norm: str) -> tuple[dict, bool] | None:
+    """L2: показання, яке вже отримав інший воркер."""
+    if shared_state is None:
+        return None
+    hit = await shared_state.run(shared_state.get, "weather", city_norm)
+    if hit is None:
+        return None
+    reading, age = hit
+    weather_cache.put(city_norm, reading, age)
+    return reading, age <= WEATHER_CACHE_TTL
+
+async def _load_reading(city_norm: str, city_raw: str, max_age: float = WEATHER_CACHE_TTL) -> tuple[dict, float] | str:
+    """
+    (показання, його вік) або текст помилки. _fetch_reading з оренди на місто:
+    поки один воркер ходить в OWM, інші чекають його результат у L2 замість власного запиту.
+    Показання з L2 старше за max_age не годиться — тоді качаємо самі.
+    """
+    if shared_state is None:
+        res = await _fetch_reading(city_norm, city_raw)
+        return (res, 0.0) if isinstance(res, dict) else res
+
+    lease = f"weather:{city_norm}"
+    deadline = time.monotonic() + WEATHER_TIMEOUT
+    while True:
+        hit = await shared_state.run(shared_state.get, "weather", city_norm)
+        if hit is not None and hit[1] <= max_age:
+            return hit
+        if await shared_state.run(shared_state.acquire, lease, WEATHER_TIMEOUT + 1):
+            break
+        if time.monotonic() > deadline:
+            break  # власник оренди завис — ідемо самі
+        await asyncio.sleep(0.05)
+
+    try:
+        res = await _fetch_reading(city_norm, city_raw)
+        if isinstance(res, dict):
+            await shared_state.run(shared_state.put, "weather", city_norm, res, WEATHER_CACHE_TTL + WEATHER_CACHE_MAX_STALE)
+            return res, 0.0
+        return res
+    finally:
+        await shared_state.run(shared_state.release, lease)
+
+async def _refresh_weather(city_norm: str, city_raw: str, max_age: float = WEATHER_CACHE_TTL):
+    try:
+        res = await weather_flight.do(city_norm, _load_reading, city_norm, city_raw, max_age)
+        if isinstance(res, tuple):
+            weather_cache.put(city_norm, *res)
+    except Exception as e:
+        log_event("weather.refresh_error", logging.WARNING, city=city_norm, error=repr(e))
+    finally:
+        _weather_refreshing.discard(city_norm)
+
+def _revalidate_weather(city_norm: str, city_raw: str, max_age: float = WEATHER_CACHE_TTL):
+    # не більше одного фонового оновлення на місто
+    if city_norm in _weather_refreshing:
+        return
+    _weather_refreshing.add(city_norm)
+    spawn(_refresh_weather(city_norm, city_raw, max_age))
+
+def _age_label(age: float) -> str:
+    minutes = int(age // 60)
+    if minutes < 1:
+        return "щойно"
+    if minutes < 60:
+        return f"{minutes} хв тому"
+    hours = minutes // 60
+    if hours < 24:
+        return f"{hours} год тому"
+    return f"{hours // 24} дн тому"
+
+async def get_weather(city_raw: str) -> str:
     if not WEATHER_API_KEY:
         return "Я не відчуваю погоду зараз 🌿 (немає ключа WEATHER_API_KEY)"
 
     city_norm = normalize_city(city_raw)
+    popularity.hit(city_norm, city_raw)
+
+    cached = weather_cache.get(city_norm) or await _shared_weather(city_norm)
+    if cached:
+        reading, fresh = cached
+        if not fresh:
+            _revalidate_weather(city_norm, city_raw)
+        return format_weather(reading)
 
     try:
-        geo = None
-        for cand in _geocode_candidates(city_norm):
-            geo = _try_geocode(cand)
-            if geo:
-                break
+        res = await weather_flight.do(city_norm, _load_reading, city_norm, city_raw)
+    except Exception as e:
+        log_event("weather.error", logging.WARNING, city=city_norm, error=repr(e))
+        last = weather_cache.last(city_norm)
+        if last is not None:
+            reading, age = last
+            return f"{format_weather(reading)}\n(дані {_age_label(age)} — погодний сервіс зараз не відповідає)"
+        if isinstance(e, CircuitOpenError):
+            return "Погодний сервіс зараз не відповідає 🌿 Спробуй за кілька хвилин."
+        return "Я спіткнувся об хмаринку 🌿 Спробуй ще раз трохи пізніше."
 
-        if not geo:
-            return f"Не можу знайти погоду для «{city_raw}» 🌿 Спробуй інше місто."
+    if isinstance(res, str):
+        return res
 
-        lat = geo["lat"]
-        lon = geo["lon"]
-        nice_name = (
-            geo.get("local_names", {}).get("uk")
-            or geo.get("name")
-            or city_raw
-        )
+    reading, age = res
+    weather_cache.put(city_norm, reading, age)
+    return format_weather(reading)
 
-        w_url = "https://api.openweathermap.org/data/2.5/weather"
-        w_params = {
-            "lat": lat,
-            "lon": lon,
-            "appid": WEATHER_API_KEY,
-            "units": "metric",
-            "lang": "uk",
-        }
-        wr = requests.get(w_url, params=w_params, timeout=10)
-        print("WEATHER:", wr.status_code)
+# ===== Forecast =====
+WEEKDAYS_UA = ("пн", "вт", "ср", "чт", "пт", "сб", "нд")
 
-        if wr.status_code != 200:
-            return f"Щось не так з погодою для «{nice_name}» 🌿"
+def _compact_forecast(payload: dict, nice_name: str) -> dict:
+    """
+    3-годинні слоти OWM -> по рядку на місцеву добу: [дата, мін, макс, main, опис].
+    Опис беремо зі слота, найближчого до 13:00. ~40 слотів стають 5–6 рядками.
+    """
+    tz = payload.get("city", {}).get("timezone", 0)
+    days: dict[str, list] = {}
+    for slot in payload.get("list", []):
+        local = datetime.fromtimestamp(slot["dt"] + tz, timezone.utc)
+        temp = slot["main"]["temp"]
+        w = (slot.get("weather") or [{}])[0]
+        to_noon = abs(local.hour - 13)
+        key = local.date().isoformat()
+        day = days.get(key)
+        if day is None:
+            days[key] = [key, temp, temp, w.get("main", ""), w.get("description", ""), to_noon]
+            continue
+        day[1] = min(day[1], temp)
+        day[2] = max(day[2], temp)
+        if to_noon < day[5]:
+            day[3], day[4], day[5] = w.get("main", ""), w.get("description", ""), to_noon
+    return {
+        "name": nice_name,
+        "tz": tz,
+        "days": [[d[0], round(d[1]), round(d[2]), d[3], d[4]] for d in days.values()],
+    }
+
+def format_forecast(fc: dict, when: str) -> str:
+    today = datetime.fromtimestamp(time.time() + fc["tz"], timezone.utc).date()
+    if when == "tomorrow":
+        key = (today + timedelta(days=1)).isoformat()
+        for day, lo, hi, main, desc in fc["days"]:
+            if day == key:
+                return f"{weather_emoji(main)} {fc['name']} завтра: {lo}…{hi}°C, {desc} 🌿"
+        return f"Прогнозу на завтра для «{fc['name']}» поки немає 🌿"
+
+    rows = [d for d in fc["days"] if d[0] >= today.isoformat()][:FORECAST_DAYS]
+    if not rows:
+        return f"Прогнозу для «{fc['name']}» поки немає 🌿"
+    lines = [f"📅 {fc['name']}, прогноз на {len(rows)} дн. 🌿"]
+    for day, lo, hi, main, desc in rows:
+        d = date.fromisoformat(day)
+        lines.append(f"{weather_emoji(main)} {WEEKDAYS_UA[d.weekday()]} {d:%d.%m}: {lo}…{hi}°C, {desc}")
+    return "\n".join(lines)
+
+# прострочений прогноз get() не віддає, але last() тримає його на час збою OWM
+forecast_cache = WeatherCache(FORECAST_CACHE_TTL, 0, FORECAST_CACHE_SIZE)
+forecast_flight = SingleFlight()
+
+async def _fetch_forecast(city_norm: str, city_raw: str) -> dict | str:
+    """Стислий прогноз (dict) або готовий текст помилки."""
+    place = await _locate(city_norm, city_raw)
+    if not place:
+        return f"Не можу знайти погоду для «{city_raw}» 🌿 Спробуй інше місто."
+    geo, nice_name = place
+
+    params = {
+        "lat": geo["lat"],
+        "lon": geo["lon"],
+        "appid": WEATHER_API_KEY,
+        "units": "metric",
+        "lang": "uk",
+    }
+    r = await owm_get("forecast", "/data/2.5/forecast", params)
+    log_event("forecast.response", city=city_norm, status=r.status_code)
+    if r.status_code != 200:
+        return f"Щось не так з прогнозом для «{nice_name}» 🌿"
+    return _compact_forecast(r.json(), nice_name)
+
+async def _load_forecast(city_norm: str, city_raw: str) -> dict | str:
+    """_fetch_forecast через L2: прогноз, який уже отримав інший воркер, не тягнемо вдруге."""
+    if shared_state is not None:
+        hit = await shared_state.run(shared_state.get, "forecast", city_norm)
+        if hit is not None and hit[1] <= FORECAST_CACHE_TTL:
+            forecast_cache.put(city_norm, hit[0], hit[1])
+            return hit[0]
+    res = await _fetch_forecast(city_norm, city_raw)
+    if isinstance(res, dict):
+        forecast_cache.put(city_norm, res)
+        if shared_state is not None:
+            await shared_state.run(shared_state.put, "forecast", city_norm, res, FORECAST_CACHE_TTL)
+    return res
 
-        w = wr.json()
-        temp = round(w["main"]["temp"])
-        feels = round(w["main"]["feels_like"])
-        desc = w["weather"][0].get("description", "")
-        main = w["weather"][0].get("main", "")
-        em = weather_emoji(main)
+async def get_forecast(city_raw: str, when: str) -> str:
+    """when: "tomorrow" або "week"; поки прогноз свіжий — без запитів в OWM."""
+    if not WEATHER_API_KEY:
+        return "Я не відчуваю погоду зараз 🌿 (немає ключа WEATHER_API_KEY)"
 
-        return f"{em} {nice_name}: {temp}°C (відчувається як {feels}°C), {desc} 🌿"
+    city_norm = normalize_city(city_raw)
+    cached = forecast_cache.get(city_norm)
+    if cached:
+        return format_forecast(cached[0], when)
 
+    try:
+        res = await forecast_flight.do(city_norm, _load_forecast, city_norm, city_raw)
     except Exception as e:
-        print("WEATHER ERROR:", repr(e))
+        log_event("forecast.error", logging.WARNING, city=city_norm, error=repr(e))
+        last = forecast_cache.last(city_norm)
+        if last is not None:
+            fc, age = last
+            return f"{format_forecast(fc, when)}\n(прогноз {_age_label(age)} — погодний сервіс зараз не відповідає)"
+        if isinstance(e, CircuitOpenError):
+            return "Погодний сервіс зараз не відповідає 🌿 Спробуй за кілька хвилин."
         return "Я спіткнувся об хмаринку 🌿 Спробуй ще раз трохи пізніше."
 
+    if isinstance(res, str):
+        return res
+    return format_forecast(res, when)
+
+_WEEK_RE = re.compile(r"\bтижд|\bтижн|\bпрогноз")
+
+def forecast_when(q: str) -> str:
+    """На коли питають: "now", "tomorrow" чи "week"."""
+    if re.search(r"\bзавтра\b", q):
+        return "tomorrow"
+    if _WEEK_RE.search(q):
+        return "week"
+    return "now"
+
+async def get_weather_many(cities: list[str], when: str = "now") -> str:
+    """Кілька міст — одна відповідь: запити йдуть паралельно, не більше WEATHER_PARALLEL водночас."""
+
+    def fetch(city: str):
+        return get_weather(city) if when == "now" else get_forecast(city, when)
+
+    if len(cities) == 1 or not WEATHER_API_KEY:
+        return await fetch(cities[0])
+
+    sem = asyncio.Semaphore(WEATHER_PARALLEL)
+
+    async def one(city: str) -> str:
+        async with sem:
+            return await fetch(city)
+
+    sep = "\n\n" if when == "week" else "\n"
+    return sep.join(await asyncio.gather(*(one(c) for c in cities)))
+
+
+# ===== Prefetch (популярні міста) =====
+class CityPopularity:
+    """
+    Лічильники запитів по містах з експоненційним згасанням (період напіврозпаду — half_life).
+    Пам'ять обмежена: понад max_size викидаємо найменш популярні.
+    """
+
+    def __init__(self, half_life: float, max_size: int = 1024):
+        self.half_life = half_life
+        self.max_size = max_size
+        self._scores: dict[str, list] = {}  # місто -> [рахунок, момент, як його писали]
+
+    def _decayed(self, item: list, now: float) -> float:
+        return item[0] * 0.5 ** ((now - item[1]) / self.half_life)
+
+    def hit(self, city_norm: str, city_raw: str, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        item = self._scores.get(city_norm)
+        if item is None:
+            if len(self._scores) >= self.max_size:
+                self._shrink(now)
+            self._scores[city_norm] = [1.0, now, city_raw]
+            return
+        item[0] = self._decayed(item, now) + 1.0
+        item[1] = now
+        item[2] = city_raw
+
+    def _shrink(self, now: float):
+        keep = heapq.nlargest(self.max_size // 2, self._scores.items(), key=lambda kv: self._decayed(kv[1], now))
+        self._scores = dict(keep)
+
+    def top(self, n: int, now: float | None = None) -> list[tuple[str, str, float]]:
+        """[(місто, як писали, рахунок)] від найпопулярнішого."""
+        now = time.monotonic() if now is None else now
+        best = heapq.nlargest(n, self._scores.items(), key=lambda kv: self._decayed(kv[1], now))
+        return [(city, item[2], self._decayed(item, now)) for city, item in best]
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+
+popularity = CityPopularity(POPULARITY_HALF_LIFE)
+PREFETCH_RUNS = register(Counter("neri_prefetch_total", "Background weather refreshes for hot cities, by result", ("result",)))
+
+
+async def prefetch_loop():
+    """
+    Раз на PREFETCH_INTERVAL: для top-N міст, чий запис у кеші скоро протухне
+    (або вже протух), запускаємо фонове оновлення — в межах бюджету запитів на хвилину.
+    """
+    if PREFETCH_TOP_N <= 0 or not WEATHER_API_KEY:
+        return
+    budget = TokenBucket(PREFETCH_BUDGET_PER_MIN / 60, PREFETCH_BUDGET_PER_MIN)
+    lead = max(PREFETCH_LEAD, 2 * PREFETCH_INTERVAL)  # інакше запис встигне протухнути між проходами
+    while True:
+        await asyncio.sleep(PREFETCH_INTERVAL)
+        if owm_breakers["weather"].state != CircuitBreaker.CLOSED:
+            continue
+        refresh_after = max(0.0, weather_cache.ttl - lead)
+        for city_norm, city_raw, _ in popularity.top(PREFETCH_TOP_N):
+            # оновлюємо лише те, що вже є в кеші: «не знайшли місто» показання не має
+            last = weather_cache.last(city_norm)
+            if last is None or last[1] < refresh_after:
+                continue
+            if city_norm in _weather_refreshing:
+                continue
+            now = time.monotonic()
+            if budget.delay(now) > 0:
+                PREFETCH_RUNS.inc("over_budget")
+                break
+            budget.consume(now)
+            PREFETCH_RUNS.inc("refreshed")
+            # показання з L2 такого ж віку — теж на межі, його не беремо
+            _revalidate_weather(city_norm, city_raw, refresh_after)
+
 
 # ===== Brain =====
 NERI_PREFIX = re.compile(r"^\s*нері\s*[,:\-–—]?\s*", re.IGNORECASE)
@@ -191,37 +1841,61 @@ def n_emo():
 
 # ===== Pronouns / gender enforcement (Нері: він/вони) =====
 FEM_TO_MASC_REPLACEMENTS = [
-    (r"\bя була\b", "я був"),
-    (r"\bя зробила\b", "я зробив"),
-    (r"\bя сказала\b", "я сказав"),
-    (r"\bя відповіла\b", "я відповів"),
-    (r"\bя хотіла\b", "я хотів"),
-    (r"\bя могла\b", "я міг"),
-    (r"\bя не могла\b", "я не міг"),
-    (r"\bя забула\b", "я забув"),
-    (r"\bя зрозуміла\b", "я зрозумів"),
-    (r"\bя думала\b", "я думав"),
-    (r"\bя бачила\b", "я бачив"),
-    (r"\bя пішла\b", "я пішов"),
-    (r"\bя прийшла\b", "я прийшов"),
-    (r"\bя стала\b", "я став"),
+    ("я була", "я був"),
+    ("я зробила", "я зробив"),
+    ("я сказала", "я сказав"),
+    ("я відповіла", "я відповів"),
+    ("я хотіла", "я хотів"),
+    ("я могла", "я міг"),
+    ("я не могла", "я не міг"),
+    ("я забула", "я забув"),
+    ("я зрозуміла", "я зрозумів"),
+    ("я думала", "я думав"),
+    ("я бачила", "я бачив"),
+    ("я пішла", "я пішов"),
+    ("я прийшла", "я прийшов"),
+    ("я стала", "я став"),
 ]
 
+# одна альтернація замість 14 окремих re.sub; заміну беремо зі словника
+_FEM_TO_MASC = {fem: masc for fem, masc in FEM_TO_MASC_REPLACEMENTS}
+_FEM_TO_MASC_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(f) for f in sorted(_FEM_TO_MASC, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE,
+)
+
 def enforce_neri_pronouns(text: str) -> str:
     t = (text or "").strip()
     if not t:
         return t
-    for pattern, repl in FEM_TO_MASC_REPLACEMENTS:
-        t = re.sub(pattern, repl, t, flags=re.IGNORECASE)
-    return t
+    return _FEM_TO_MASC_RE.sub(lambda m: _FEM_TO_MASC[m.group(0).lower()], t)
 
-# ===== “екстравертність” =====
-def neri_style(text: str) -> str:
-    if not text:
+# ===== Reply pipeline =====
+class ReplyPipeline:
+    """
+    Пост-обробка відповіді: етапи у фіксованому порядку.
+    Етап — функція (text, kind) -> text, kind потрібен лише комбінатору smalltalk.
+    """
+
+    def __init__(self, *stages):
+        self.stages = stages
+
+    def run(self, text: str, kind: str | None = None) -> str:
+        if not text:
+            return text
+        for stage in self.stages:
+            text = stage(text, kind)
         return text
 
-    t = text.strip()
 
+# усі ці емодзі — один code point, тож вистачає перевірити останній символ
+STYLE_EMOJI_TAILS = frozenset(("🌿", "✨", "💚", "😼", "👀", "🍃", "🌱", "🍀", "🪴", "🌸", "🌼"))
+
+def _stage_strip(t: str, kind: str | None) -> str:
+    return t.strip()
+
+# ===== “екстравертність” =====
+def _stage_caps(t: str, kind: str | None) -> str:
     # 25% шанс зробити одне слово/фразу капсом
     if random.random() < 0.25:
         words = t.split()
@@ -229,107 +1903,426 @@ def neri_style(text: str) -> str:
             i = random.randint(0, len(words) - 1)
             words[i] = words[i].upper()
             t = " ".join(words)
+    return t
 
+def _stage_emoji(t: str, kind: str | None) -> str:
     # емодзі інколи
     if random.random() < 0.25 and len(t) < 260:
-        if not t.endswith(("🌿","✨","💚","😼","👀","🍃","🌱","🍀","🪴","🌸","🌼")):
+        if t[-1:] not in STYLE_EMOJI_TAILS:
             t = t + " " + n_emo()
-
-    t = enforce_neri_pronouns(t)
     return t
 
-NERI_AGE = 2
-NERI_BDAY = "16.09.2025"
+def _stage_pronouns(t: str, kind: str | None) -> str:
+    return enforce_neri_pronouns(t)
 
-# ===== Pronouns Q/A =====
-def is_pronouns_query(q: str) -> bool:
-    return ("займенник" in q) or ("займенники" in q) or ("pronouns" in q)
+STYLE_STAGES = (_stage_strip, _stage_caps, _stage_emoji, _stage_pronouns)
+NERI_STYLE = ReplyPipeline(*STYLE_STAGES)
 
+def neri_style(text: str) -> str:
+    return NERI_STYLE.run(text)
+
+# ===== Pronouns Q/A =====
 def pronouns_reply() -> str:
     return "Мої займенники — він/вони 🌿"
 
-# ===== Mom/Dad =====
-def is_mom_query(q: str) -> bool:
-    return ("хто" in q) and ("мама" in q or "матуся" in q or "матi" in q or "мать" in q)
+# ===== Team profiles (хто такий/така) =====
+# самі профілі, аліаси й думки — у пакеті персони (persona/pack.json)
+def _clean_name_token(s: str) -> str:
+    s = (s or "").strip().lower()
+    s = s.replace("’", "'").replace("ʼ", "'")
+    s = re.sub(r"^[^\wа-щьюяєіїґ\-']+|[^\wа-щьюяєіїґ\-']+$", "", s, flags=re.IGNORECASE)
+    return s
 
-def is_dad_query(q: str) -> bool:
-    return ("хто" in q) and ("тато" in q or "татусь" in q or "батько" in q)
+# ===== Name index (відмінки, описки) =====
+NAME_MATCH_THRESHOLD = 0.75  # одна правка (0.775) — так, дві (0.7) — ні, їх resolve() і не шукає
+NAME_FUZZY_MIN_LEN = 5  # коротші імена («лі», «торі», «піна») — лише точно або за основою аліасу
+
+# закінчення відмінків, від довших до коротших
+_NAME_SUFFIXES = sorted(
+    ["ові", "еві", "ому", "ого", "ою", "ею", "ом", "ем", "ям", "ах", "ях", "ів",
+     "у", "ю", "а", "я", "і", "ї", "е", "о", "и"],
+    key=len, reverse=True,
+)
+
+def _name_stem(s: str) -> str:
+    for suf in _NAME_SUFFIXES:
+        if s.endswith(suf) and len(s) - len(suf) >= 3:
+            return s[:-len(suf)]
+    return s
 
-MOM_REPLIES = [
-    "Рітерум (Рум) — моя матуся 💚🌿",
-    "Моя матуся — Рітерум. Її ще звуть Рум 🌿✨",
-    "Рум — матуся. Тут без варіантів 😼🌿",
-]
+def _trigrams(s: str) -> set[str]:
+    s = f"#{s}#"
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+def _bounded_levenshtein(a: str, b: str, max_d: int) -> int:
+    """Відстань редагування або max_d + 1, якщо вона більша за max_d."""
+    if abs(len(a) - len(b)) > max_d:
+        return max_d + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        row_min = i
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            row_min = min(row_min, cur[j])
+        if row_min > max_d:
+            return max_d + 1
+        prev = cur
+    return prev[-1]
+
+
+class NameIndex:
+    """
+    Індекс імен команди: точні аліаси, основи без відмінкових закінчень
+    і триграми для описок. resolve() повертає (ключ профілю, впевненість).
+    """
 
-DAD_REPLIES = [
-    "Лірен — мій татусь 💚🌿",
-    "Мій татусь — Лірен. Сильна опора 🌳✨",
-    "Лірен — татусь. Я це знаю серцем 🌿",
-]
+    def __init__(self, aliases: dict[str, list[str]], profiles: dict[str, dict]):
+        terms: dict[str, str] = {}
+        for key, als in aliases.items():
+            for a in [key] + als:
+                terms[_clean_name_token(a)] = key
+        for key, prof in profiles.items():
+            for field in ("name", "ua"):
+                t = _clean_name_token(prof.get(field, ""))
+                if t:
+                    terms.setdefault(t, key)
+        terms.pop("", None)
+
+        self._exact = terms
+        self._stems: dict[str, str] = {}
+        ambiguous = set()
+        for t, key in terms.items():
+            st = _name_stem(t)
+            if self._stems.get(st, key) != key:
+                ambiguous.add(st)
+            self._stems[st] = key
+        for st in ambiguous:
+            del self._stems[st]
+
+        self._terms = list(terms.items())
+        self._grams: dict[str, list[int]] = {}
+        for i, (t, _) in enumerate(self._terms):
+            for g in _trigrams(t):
+                self._grams.setdefault(g, []).append(i)
+
+    def resolve(self, name: str) -> tuple[str, float] | None:
+        t = _clean_name_token(name)
+        if not t:
+            return None
+        key = self._exact.get(t)
+        if key:
+            return key, 1.0
+
+        # основу порівнюємо лише з основами аліасів: «марія» -> «марі» не те саме, що аліас «марі»
+        st = _name_stem(t)
+        key = self._stems.get(st)
+        if key:
+            return key, 0.9
+
+        if len(t) < NAME_FUZZY_MIN_LEN:
+            return None
+
+        # кандидати — терміни зі спільними триграмами, далі обмежений Левенштейн
+        counts: dict[int, int] = {}
+        for g in _trigrams(t):
+            for i in self._grams.get(g, ()):
+                counts[i] = counts.get(i, 0) + 1
+        best = None
+        for i in sorted(counts, key=counts.get, reverse=True)[:8]:
+            term, key = self._terms[i]
+            if len(term) < NAME_FUZZY_MIN_LEN:
+                continue
+            d = _bounded_levenshtein(t, term, 1)
+            if len(st) >= NAME_FUZZY_MIN_LEN:
+                d = min(d, _bounded_levenshtein(st, term, 1))
+            if d > 1:
+                continue
+            score = 0.85 - 0.075 * d
+            if best is None or score > best[1]:
+                best = (key, score)
+        return best
+
+
+# ===== Persona pack =====
+PERSONA_PACK = os.getenv(
+    "PERSONA_PACK", os.path.join(os.path.dirname(os.path.abspath(__file__)), "persona", "pack.json")
+)
+
+# пули відповідей, без яких бот не працює
+PERSONA_REPLY_POOLS = ("hi", "mom", "dad", "about", "interesting", "age", "bday", "fallback", "punish", "punish_extra")
+
+
+class PersonaError(ValueError):
+    pass
+
+
+def _str_list(v) -> bool:
+    return isinstance(v, list) and bool(v) and all(isinstance(x, str) and x.strip() for x in v)
+
+
+def _strs(v) -> bool:
+    """Список рядків, можна порожній."""
+    return isinstance(v, list) and all(isinstance(x, str) for x in v)
+
+
+def validate_persona(pack: dict) -> list[str]:
+    """Список помилок пакета; порожній — пакет можна компілювати."""
+    errors = []
+    if not isinstance(pack, dict):
+        return ["pack must be a JSON object"]
+    if not isinstance(pack.get("version"), str) or not pack["version"]:
+        errors.append("version: missing")
+
+    profiles = pack.get("profiles")
+    if not isinstance(profiles, dict) or not profiles:
+        errors.append("profiles: missing")
+        profiles = {}
+    owner: dict[str, str] = {}
+    for key, prof in profiles.items():
+        if not isinstance(prof, dict):
+            errors.append(f"profiles.{key}: must be an object")
+            continue
+        for field in ("name", "role"):
+            if not isinstance(prof.get(field), str) or not prof[field]:
+                errors.append(f"profiles.{key}.{field}: missing")
+        for field in ("ua", "link"):
+            if not isinstance(prof.get(field, ""), str):
+                errors.append(f"profiles.{key}.{field}: must be a string")
+        if "opinions" in prof and not _str_list(prof["opinions"]):
+            errors.append(f"profiles.{key}.opinions: must be a non-empty list of strings")
+        aliases = prof.get("aliases", [])
+        if not _strs(aliases):
+            errors.append(f"profiles.{key}.aliases: must be a list of strings")
+            continue
+        for a in aliases:
+            a = a.lower()
+            if owner.get(a, key) != key:
+                errors.append(f"profiles.{key}.aliases: '{a}' already belongs to {owner[a]}")
+            owner[a] = key
+
+    replies = pack.get("replies")
+    if not isinstance(replies, dict):
+        errors.append("replies: missing")
+        replies = {}
+    for pool in dict.fromkeys(PERSONA_REPLY_POOLS + tuple(replies)):
+        if not _str_list(replies.get(pool)):
+            errors.append(f"replies.{pool}: must be a non-empty list of strings")
+    for t in replies.get("punish") if _str_list(replies.get("punish")) else ():
+        try:
+            t.format(name="x", emo="x")
+        except (KeyError, IndexError, ValueError):
+            errors.append(f"replies.punish: bad template {t!r} (only {{name}} and {{emo}})")
+
+    st = pack.get("smalltalk")
+    if not isinstance(st, dict):
+        errors.append("smalltalk: missing")
+        st = {}
+    kinds = st.get("kinds")
+    if not isinstance(kinds, list) or not kinds:
+        errors.append("smalltalk.kinds: missing")
+        kinds = []
+    for i, k in enumerate(kinds):
+        if not isinstance(k, dict) or not isinstance(k.get("kind"), str) or not k["kind"]:
+            errors.append(f"smalltalk.kinds[{i}].kind: missing")
+            continue
+        if not _str_list(k.get("replies")):
+            errors.append(f"smalltalk.{k['kind']}.replies: must be a non-empty list of strings")
+        if not _str_list(k.get("patterns")):
+            errors.append(f"smalltalk.{k['kind']}.patterns: must be a non-empty list of strings")
+            continue
+        for pat in k["patterns"]:
+            try:
+                re.compile(pat)
+            except re.error as e:
+                errors.append(f"smalltalk.{k['kind']}.patterns: {pat!r}: {e}")
+    if not _strs(pack.get("not_names", [])):
+        errors.append("not_names: must be a list of strings")
+    neri = pack.get("neri", {})
+    if not isinstance(neri, dict) or not all(isinstance(v, (str, int, float)) for v in neri.values()):
+        errors.append("neri: must be an object of strings")
+
+    if not _strs(st.get("headers")):
+        errors.append("smalltalk.headers: must be a list of strings")
+    if not _strs(st.get("support_kinds", [])):
+        errors.append("smalltalk.support_kinds: must be a list of strings")
+    tails = st.get("tails")
+    if not isinstance(tails, dict):
+        tails = {}
+    for name in ("vibes", "questions", "support"):
+        if not _str_list(tails.get(name)):
+            errors.append(f"smalltalk.tails.{name}: must be a non-empty list of strings")
+    return errors
+
+
+class Persona:
+    """
+    Скомпільований пакет персони: профілі команди, пули відповідей,
+    індекс імен і regex smalltalk. Після створення не змінюється —
+    перезавантаження підміняє весь об'єкт PERSONA.
+    """
 
-# ===== Team profiles (хто такий/така) =====
-TEAM_PROFILES = {
-    "nerineris": {"name": "Nerineris", "ua": "Нері", "role": "Найкраща пусічка у СВІТІ", "link": "https://t.me/Nerineris"},
-    "riterum":   {"name": "Riterum (Рум)", "ua": "Рітерум", "role": "Лідер, вокал, переклад, SMM", "link": "https://t.me/AriaTerum"},
-    "liren":     {"name": "LiRen", "ua": "Лірен", "role": "Лідер, вокал, ілюстрації, переклад", "link": "https://t.me/LiRen_Arts"},
-    "daze":      {"name": "daze", "ua": "Дейз", "role": "Адмін, відео", "link": "https://t.me/korobkadaze"},
-    "tori":      {"name": "Tori_frr", "ua": "Торі", "role": "Адмін, вокал, переклад, ілюстрації, відео", "link": "https://t.me/Kaganuka"},
-    "pina":      {"name": "ПІНОПЛАСТІВОЧКА", "ua": "Піна", "role": "Вокал, ілюстрації, переклад", "link": "https://t.me/vezha_pinoplastivochky"},
-    "alyvian":   {"name": "Alyvian", "ua": "Алувіан", "role": "Адмін, вокал, гармонії", "link": "https://t.me/alyviancovers"},
-    "miraj":     {"name": "Miraj", "ua": "Мірай", "role": "Вокал, гармонії", "link": ""},
-    "stellar":   {"name": "StellarSkriM", "ua": "Стеллар", "role": "Зведення", "link": "https://t.me/StellarSkriMRoom"},
-    "rybka":     {"name": "Рибка", "ua": "Рибка", "role": "Відео", "link": ""},
-    "lee":       {"name": "Lee", "ua": "Лі", "role": "Ілюстрації", "link": "https://t.me/artdisainli"},
-    "moka":      {"name": "мокатроля", "ua": "Мока", "role": "Ілюстрації", "link": "https://x.com/mokatrola"},
-    "inky":      {"name": "InkyLove", "ua": "Інкі", "role": "Вокал", "link": "https://t.me/inky_Love_Ua"},
-    "lesya":     {"name": "Леся/moemoenya", "ua": "Леся", "role": "Ілюстрації", "link": "https://t.me/moemoenya"},
-    "mari":      {"name": "MARi", "ua": "Марі", "role": "Вокал, зведення, гармонії", "link": "https://t.me/maricovers"},
-    "dreamu":    {"name": "Dreamu", "ua": "Дрімі", "role": "Ілюстрації", "link": ""},
-    "illya":     {"name": "Ілля", "ua": "Ілля", "role": "Зведення", "link": ""},
-    "pechenieg": {"name": "pechenig", "ua": "печеніг", "role": "Ілюстрації, відео", "link": "https://t.me/pechenig_tg"},
-    "zhuk":      {"name": "Дмитро Жук", "ua": "Жук", "role": "Ілюстрації", "link": "https://t.me/duke_zhukem"},
-    "azri":      {"name": "Azri", "ua": "Азрі", "role": "Вокал, зведення", "link": ""},
-}
+    FORMAT = 1  # змінюється разом зі структурою класу — старі .pickle тоді перекомпілюються
+
+    def __init__(self, pack: dict):
+        errors = validate_persona(pack)
+        if errors:
+            raise PersonaError("; ".join(errors))
+        try:
+            self._compile(pack)
+        except (TypeError, AttributeError, KeyError) as e:
+            # те, що пропустив validate_persona, — теж помилка пакета, а не 500
+            raise PersonaError(f"bad pack: {e!r}") from e
+
+    def _compile(self, pack: dict):
+        self.format = Persona.FORMAT
+        self.version = pack["version"]
+
+        profiles = pack["profiles"]
+        self.profiles = {
+            key: {f: prof.get(f, "") for f in ("name", "ua", "role", "link")}
+            for key, prof in profiles.items()
+        }
+        self.profile_keys = tuple(self.profiles)
+        self.alias_to_key = {a.lower(): key for key, prof in profiles.items() for a in prof.get("aliases", [])}
+        self.opinions = {key: tuple(prof["opinions"]) for key, prof in profiles.items() if prof.get("opinions")}
+        self.name_index = NameIndex({key: prof.get("aliases", []) for key, prof in profiles.items()}, self.profiles)
+        # звичайні слова, які не мають ставати учасниками команди
+        hits = []
+        for word in pack.get("not_names", ()):
+            hit = self.name_index.resolve(word)
+            if hit and hit[1] >= NAME_MATCH_THRESHOLD:
+                hits.append(f"not_names: {word!r} resolves to {hit[0]} ({hit[1]:.3f})")
+        if hits:
+            raise PersonaError("; ".join(hits))
+
+        neri = pack.get("neri") or {}
+        subst = {f"{{{k}}}": str(v) for k, v in neri.items()}
+
+        def fill(t: str) -> str:
+            for k, v in subst.items():
+                t = t.replace(k, v)
+            return t
+
+        self.replies = {
+            pool: tuple(t if pool == "punish" else fill(t) for t in items)
+            for pool, items in pack["replies"].items()
+        }
 
-PROFILE_ALIASES = {
-    "nerineris": ["nerineris", "нері", "neri"],
-    "riterum":   ["riterum", "рітерум", "рум", "rit", "ритерум"],
-    "liren":     ["liren", "лірен", "ліренчик", "лірену", "лірена"],
-    "daze":      ["daze", "дейз", "deiz"],
-    "tori":      ["tori", "tori_frr", "торі", "тори"],
-    "pina":      ["піна", "пінопластівочка", "pinoplastivochka", "pina"],
-    "alyvian":   ["alyvian", "алувіан", "aluvian"],
-    "miraj":     ["miraj", "мірай"],
-    "stellar":   ["stellarskrim", "stellar", "стеллар", "стелларскрім"],
-    "rybka":     ["рибка"],
-    "lee":       ["lee", "лі"],
-    "moka":      ["мока", "мокатрола", "mokatrola"],
-    "inky":      ["inky", "inkylove", "інкі"],
-    "lesya":     ["леся", "moemoenya"],
-    "mari":      ["mari", "марі", "maricovers"],
-    "dreamu":    ["dreamu", "дрімі", "dreamy"],
-    "illya":     ["ілля", "illya"],
-    "pechenieg": ["печеніг", "pechenieg", "pechenig"],
-    "zhuk":      ["жук", "dmytro", "дуке", "duke_zhukem", "дмитро жук"],
-    "azri":      ["азрі", "azri", "azry"],
-}
+        # по одному regex на вид, порядок видів — пріоритет
+        st = pack["smalltalk"]
+        self.smalltalk = tuple(
+            (re.compile("|".join(f"(?:{p})" for p in k["patterns"])), tuple(k["replies"]), k["kind"])
+            for k in st["kinds"]
+        )
+        self.headers = tuple(st["headers"])
+        tails = st["tails"]
+        self.tails_default = tuple(tails["vibes"] + tails["questions"])
+        support = self.tails_default + tuple(tails["support"])
+        self.tails_by_kind = {kind: support for kind in st.get("support_kinds", ())}
 
-ALIAS_TO_PROFILE_KEY: dict[str, str] = {}
-for key, als in PROFILE_ALIASES.items():
-    for a in als:
-        ALIAS_TO_PROFILE_KEY[a.lower()] = key
 
-def _clean_name_token(s: str) -> str:
-    s = (s or "").strip().lower()
-    s = s.replace("’", "'").replace("ʼ", "'")
-    s = re.sub(r"^[^\wа-щьюяєіїґ\-']+|[^\wа-щьюяєіїґ\-']+$", "", s, flags=re.IGNORECASE)
-    return s
+def compiled_persona_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".pickle"
+
+
+def compile_persona(path: str, out: str | None = None) -> Persona:
+    """Офлайн-крок: перевірити JSON і зберегти готовий Persona поруч (.pickle)."""
+    with open(path, encoding="utf-8") as f:
+        persona = Persona(json.load(f))
+    out = out or compiled_persona_path(path)
+    tmp = f"{out}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        pickle.dump(persona, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, out)
+    return persona
+
+
+def load_persona(path: str) -> Persona:
+    """Скомпільований .pickle, якщо він не старший за JSON; інакше компілюємо JSON тут."""
+    compiled = compiled_persona_path(path)
+    try:
+        if os.path.getmtime(compiled) >= os.path.getmtime(path):
+            with open(compiled, "rb") as f:
+                persona = pickle.load(f)
+            if isinstance(persona, Persona) and getattr(persona, "format", None) == Persona.FORMAT:
+                return persona
+    except OSError:
+        pass
+    except Exception as e:
+        # .pickle від старого коду (ImportError/AttributeError/...) — просто компілюємо JSON
+        log_event("persona.pickle_stale", logging.WARNING, path=compiled, error=repr(e))
+    with open(path, encoding="utf-8") as f:
+        return Persona(json.load(f))
+
+
+PERSONA = load_persona(PERSONA_PACK)
+
+
+# останній запис "persona/pack" у SharedState, який цей воркер уже бачив
+_persona_sync: dict = {"seen": None}
+
+
+async def reload_persona(publish: bool = True) -> Persona:
+    """
+    Компіляція/читання — в окремому потоці, підміна — одним присвоєнням.
+    Обробники читають PERSONA без await посередині, тож бачать або старий, або новий пакет.
+    publish — записати версію в SharedState, щоб решта воркерів перечитала пакет (watch_persona).
+    """
+    global PERSONA
+    persona = await asyncio.to_thread(load_persona, PERSONA_PACK)
+    old = PERSONA.version
+    PERSONA = persona
+    log_event("persona.reloaded", old=old, version=persona.version)
+    if publish and shared_state is not None:
+        rec = {"version": persona.version, "ts": time.time(), "owner": shared_state.owner}
+        try:
+            # TTL — рік: запис потрібен, доки живуть воркери
+            await shared_state.run(shared_state.put, "persona", "pack", rec, 365 * 86400)
+            _persona_sync["seen"] = rec
+        except sqlite3.Error as e:
+            log_event("persona.publish_failed", logging.WARNING, error=repr(e))
+    return persona
+
+
+async def _reload_persona_logged(publish: bool = True):
+    try:
+        await reload_persona(publish)
+    except (OSError, ValueError) as e:
+        log_event("persona.reload_failed", logging.ERROR, error=str(e))
+
+
+async def watch_persona():
+    """
+    /admin/reload і SIGHUP приходять в один воркер; він пише версію в SharedState,
+    а решта раз на PERSONA_SYNC_INTERVAL бачить новий запис і перечитує пакет з диска.
+    """
+    if shared_state is None:
+        return
+    first = True
+    while True:
+        try:
+            hit = await shared_state.run(shared_state.get, "persona", "pack")
+        except sqlite3.Error as e:
+            log_event("persona.sync_error", logging.WARNING, error=repr(e))
+            hit = None
+        rec = hit[0] if hit else None
+        if rec is not None and rec != _persona_sync["seen"]:
+            _persona_sync["seen"] = rec
+            # запис зі старту — не новина: пакет щойно прочитано з диска
+            if not first and rec.get("version") != PERSONA.version:
+                await _reload_persona_logged(publish=False)
+        first = False
+        await asyncio.sleep(PERSONA_SYNC_INTERVAL)
 
 def canonical_profile_key(name_raw: str) -> str:
     key = _clean_name_token(name_raw)
     if not key:
         return ""
-    return ALIAS_TO_PROFILE_KEY.get(key, key)
+    hit = PERSONA.name_index.resolve(key)
+    if hit and hit[1] >= NAME_MATCH_THRESHOLD:
+        return hit[0]
+    return key
 
 def extract_quoted_name(raw: str) -> str | None:
     m = re.search(r"[\"“”'‘’](.+?)[\"“”'‘’]", raw)
@@ -359,7 +2352,7 @@ def extract_name_after_preposition(q: str, prep: str) -> str | None:
     # 2-слова (на випадок "дмитро жук")
     if len(parts) >= 2:
         cand2 = _clean_name_token(parts[0] + " " + parts[1])
-        if cand2 and cand2 in ALIAS_TO_PROFILE_KEY:
+        if cand2 and cand2 in PERSONA.alias_to_key:
             return parts[0] + " " + parts[1]
 
     # 1-слово
@@ -385,7 +2378,7 @@ def answer_who_is(raw_text: str, q: str) -> str | None:
             if parts:
                 if len(parts) >= 2:
                     cand2 = _clean_name_token(parts[0] + " " + parts[1])
-                    if cand2 and cand2 in ALIAS_TO_PROFILE_KEY:
+                    if cand2 and cand2 in PERSONA.alias_to_key:
                         name = parts[0] + " " + parts[1]
                     else:
                         name = parts[0]
@@ -396,7 +2389,7 @@ def answer_who_is(raw_text: str, q: str) -> str | None:
         return None
 
     k = canonical_profile_key(name)
-    prof = TEAM_PROFILES.get(k)
+    prof = PERSONA.profiles.get(k)
     if not prof:
         return None
 
@@ -406,28 +2399,6 @@ def answer_who_is(raw_text: str, q: str) -> str | None:
     return neri_style(line)
 
 # ===== Member opinions (як відносишся/що думаєш) =====
-MEMBER_OPINIONS = {
-    "riterum": ["Рітерум (Рум) — моя матуся 💚🌿", "Рум — матуся. Теплий корінь команди 🌿✨"],
-    "liren":   ["Лірен — мій татусь 💚🌿", "Лірен — татусь. Сильна опора 🌳✨"],
-    "tori":    ["Торі? Мені подобаються її вушка 🐾🌿", "Торі — вайбова. І вушка топ ✨🌿"],
-    "daze":    ["Дейз — мій відео-двигун 🌿🎬", "Дейз робить рух і ритм. Це повага 😼🌿"],
-    "pina":    ["Піна — голос, що цвіте 🌸💚", "Піна — дуже ніжний вайб 🌿✨"],
-    "alyvian": ["Алувіан — справжній вайб 🍃😼", "Алувіан — звучить сильно 🌿✨"],
-    "miraj":   ["Мірай — м’яка як вечірній вітер 🍃✨", "Мірай — тепла присутність 🌿💚"],
-    "stellar": ["Стеллар — зведення як зорі на небі 🌙✨", "Стеллар — дуже потужно по звуку 🌿✨"],
-    "rybka":   ["Рибка — монтаж летить, як листя у вітрі 🍃✨", "Рибка — нереальний монтажер 🌿🔥"],
-    "lee":     ["Лі — стилю вистачить на цілий сад 🌿✨", "Лі — неймовірний артстайл 🎨🌿"],
-    "moka":    ["Мока — малює так, що хочеться квітнути 🌱💚", "Мока — дуже гарні арти 🌿✨"],
-    "inky":    ["Інкі — загадка. Але загадки теж гарні 🍃✨", "Інкі — я тримаю їй місце в саду 🌿"],
-    "lesya":   ["Леся — оце енергія! 🌿😼", "Леся — прям СОНЦЕ ✨🌿"],
-    "mari":    ["Марі — голос, що гріє 🌞🌿", "Марі — неймовірний вокал 🎤🌿"],
-    "dreamu":  ["Дрімі — малюнки як сон 🌙🌿", "Дрімі — дуже ніжні арти 🌿✨"],
-    "illya":   ["Ілля — звук як чисте повітря 🌿✨", "Ілля — зведення нереальні 🎛️🌿"],
-    "pechenieg":["печеніг — інколи приносить легенди 🍃✨", "печеніг — вайбово і творчо 😼🌿"],
-    "zhuk":    ["Жук — арти як вибух цвіту 🌸✨", "Жук — НЕРЕАЛЬНІ АРТИ!! 🎨🔥🌿"],
-    "azri":    ["Азрі — фуряшки наступають… і я не проти 😼🍃", "Азрі — атака фуряшками 🐾🌿"],
-}
-
 def handle_member_opinion(raw_text: str, q: str) -> str | None:
     # ЯВНО: "як ти відносишся до X" / "твоє відношення до X" / "що думаєш про X"
     if not re.search(r"(відносиш|відношенн|ставиш|думаєш)", q):
@@ -449,8 +2420,9 @@ def handle_member_opinion(raw_text: str, q: str) -> str | None:
 
     k = canonical_profile_key(name)
 
-    if k in MEMBER_OPINIONS:
-        return neri_style(random.choice(MEMBER_OPINIONS[k]))
+    opinions = PERSONA.opinions.get(k)
+    if opinions:
+        return neri_style(random.choice(opinions))
 
     # fallback якщо ім'я не знайшли
     return neri_style(f"Я думаю, що {name} — частина нашого саду. І це вже багато 💚")
@@ -459,19 +2431,6 @@ def handle_member_opinion(raw_text: str, q: str) -> str | None:
 def is_punish_query(q: str) -> bool:
     return ("покар" in q) or ("накаж" in q) or ("мут" in q)
 
-PUNISH_TEMPLATES = [
-    "⚖️ {name}, вирок від Нері: 10 хвилин тиші і 1 (одна) добра справа. Потім — назад у сад {emo}💚",
-    "🌿 {name}, я тебе не бʼю — я тебе виховую: виправляйся і квітни {emo}😼",
-    "🍃 {name}, штраф: повернути атмосферу на місце. Плюс 3 компліменти команді {emo}✨",
-    "🪴 {name}, покарання: відкласти токс і принести чай/воду. Гідратація — це закон {emo}",
-    "🌸 {name}, вирок: 5 хвилин 'я хороший/хороша' і жодних сварок. Я стежу 👀 {emo}",
-]
-PUNISH_EXTRA = [
-    "Якщо не виконаєш — листочок буде сумувати 🌿😿",
-    "Виконаєш — отримаєш +1 обійм по-нерівськи 🍃💚",
-    "Це все жарт, але атмосфера — серйозна 😼🌿",
-]
-
 def extract_name_after_keyword(q: str, keyword_root: str) -> str | None:
     parts = q.split()
     for i, w in enumerate(parts):
@@ -500,58 +2459,36 @@ def handle_punish(raw_text: str, q: str) -> str | None:
     if k == "nerineris" or "нері" in (name or "").lower():
         return neri_style("Я себе не караю 😼🌿 Я краще квітну. А кого караємо?")
 
+    persona = PERSONA
     nice = name.strip()
-    prof = TEAM_PROFILES.get(k)
+    prof = persona.profiles.get(k)
     if prof:
         nice = prof["name"]
 
     emo = n_emo()
-    base = random.choice(PUNISH_TEMPLATES).format(name=nice, emo=emo)
-    tail = random.choice(PUNISH_EXTRA)
+    base = random.choice(persona.replies["punish"]).format(name=nice, emo=emo)
+    tail = random.choice(persona.replies["punish_extra"])
     return neri_style(f"{base}\n{tail}")
 
 # ===== політика/війна — табу =====
 SERIOUS_KEYWORDS = ["політик", "вибор", "парті", "війна", "фронт", "зброя", "ракета"]
-def is_serious_topic(q: str) -> bool:
-    return any(k in q for k in SERIOUS_KEYWORDS)
-
 def serious_refusal() -> str:
     return "Я не говорю про політику/війну 🌿 Давай краще про щось тепле й командне 💚"
 
 # ===== Команди/довідка =====
-def is_cmds_query(q: str) -> bool:
-    if re.search(r"\bкоманд(и|а)?\b", q):
-        return True
-    if ("що" in q and "вмі" in q):
-        return True
-    return False
-
 # ===== Random member (випадковий учасник) ✅ ДОДАНО =====
-def is_random_member_query(q: str) -> bool:
-    return ("випадков" in q) and ("учасник" in q or "учасника" in q or "мембер" in q or "member" in q)
-
 def random_member_reply() -> str:
-    k = random.choice(list(TEAM_PROFILES.keys()))
-    prof = TEAM_PROFILES[k]
+    persona = PERSONA
+    k = random.choice(persona.profile_keys)
+    prof = persona.profiles[k]
     line = f"Випадковий учасник: {prof['name']} 🌿"
     if prof.get("link"):
         line += f"\n{prof['link']}"
     return line
 
 # ===== "Нері, привіт" ✅ ДОДАНО =====
-def is_hi_query(q: str) -> bool:
-    qq = (q or "").strip().lower()
-    return qq in ("привіт", "привiт", "хай", "хей", "йо", "hello", "hi")
-
-HI_REPLIES = [
-    "Привіт 😼🌿 Я Нері. Як ти?",
-    "Хей-хей! Я тут 🌿✨ Що робимо?",
-    "Привіт! Тримаю атмосферу 💚🌿",
-    "Оу 👀 Привіт-привіт! Як день?",
-]
-
 def hi_reply() -> str:
-    return random.choice(HI_REPLIES)
+    return random.choice(PERSONA.replies["hi"])
 
 def commands_text() -> str:
     return (
@@ -572,38 +2509,6 @@ def commands_text() -> str:
         "Якщо напишеш криво — нічого, я все одно спробую зрозуміти 🌿"
     )
 
-ABOUT_REPLIES = [
-    "Я Нері — маскот і символ команди 💚🌿 Їхня душа й атмосфера ✨",
-    "Нері — це не просто імʼя. Це символ команди 🌿✨",
-    "Я Нері: маскот, талісман і тиха сила команди 🌱✨",
-    "Я тут для допомоги, ігор і атмосфери 💚🌿",
-    "Я ніжний і турботливий, АЛЕ ДУЖЕ ТОВАРИСЬКИЙ 😼🌿✨",
-    "Я люблю побазікати, природу, музику і зелений чай 🍵🌿",
-]
-
-INTERESTING_REPLIES = [
-    "Іноді найкраща атмосфера — коли всі просто тихо поруч 🌿",
-    "Коли чат теплий — я буквально квітну 🌱✨",
-    "Маленькі кроки теж кроки. Особливо якщо вони в правильний бік 🍃",
-    "Якщо ти читаєш це — ти вже тут. А це багато ✨🌿",
-    "Видих. Ще один. І стає легше 🍃🌿",
-]
-
-def is_about_query(q: str) -> bool:
-    return ("розкажи" in q and "про" in q and "себе") or ("хто" in q and "ти" in q)
-
-def is_interesting_query(q: str) -> bool:
-    return ("розкажи" in q and ("цікав" in q or "цікавеньк" in q)) or ("розкажи" in q and "щось" in q)
-
-def is_age_query(q: str) -> bool:
-    return ("скільки" in q and "рок" in q) or ("вік" in q)
-
-def is_bday_query(q: str) -> bool:
-    return ("день" in q and "народж") or ("коли" in q and "народж" in q)
-
-def is_greet_new_query(q: str) -> bool:
-    return "привітайся" in q or "привітай" in q
-
 def greet_new_member_text() -> str:
     return (
         "Привіт! Я Нері — маскот команди 💚🌿 Радий знайомству!\n"
@@ -617,62 +2522,6 @@ def _norm_ua(s: str) -> str:
     s = re.sub(r"\s+", " ", s)
     return s
 
-def _match_any(q: str, patterns: list[str]) -> bool:
-    return any(re.search(p, q) for p in patterns)
-
-P_HOW_ARE_YOU = [
-    r"\bяк\s+ти\b",
-    r"\bяк\s+справ[иі]\b",
-    r"\bяк\s+воно\b",
-    r"\bяк\s+настр[оі]й\b",
-    r"\bти\s+норм\b",
-]
-P_WHAT_DOING_NOW = [
-    r"\bшо\s+робиш\b",
-    r"\bщо\s+робиш\b",
-    r"\bчим\s+займаєшс(я|ь)\b",
-]
-P_WHAT_DID_YESTERDAY = [
-    r"\bшо\s+робив\s+вчора\b",
-    r"\bщо\s+робив\s+вчора\b",
-    r"\bяк\s+вчора\b",
-]
-P_HOW_DAY = [
-    r"\bяк\s+день\b",
-    r"\bяк\s+сьогодн(і|я)\b",
-    r"\bщо\s+по\s+дню\b",
-]
-
-R_HOW_ARE_YOU = [
-    "Я окей 🌿 Спокійно, тепло.",
-    "Квітну потроху 🌱",
-    "Я тут, на звʼязку 😼🌿",
-    "Я в ресурсі 😼🍃",
-    "Тепло. Як чай, що не обпікає 🍵🌿",
-]
-R_WHAT_DOING_NOW = [
-    "Слухаю чат і тримаю атмосферу 🌿😼",
-    "Зараз? Дихаю зеленим чаєм уявно 🍵🌿",
-    "Я тут — відповідаю, допомагаю, несу вайб ✨🌿",
-]
-R_WHAT_DID_YESTERDAY = [
-    "Вчора? Тримав атмосферу і слухав людей 🌿",
-    "Вчора — чай, тиша і трохи розмов 🍵🌿",
-    "Вчора допомагав, коли мене кликали 👀🌿",
-]
-R_HOW_DAY = [
-    "Сьогодні рівно. Трохи справ — трохи спокою 🌿",
-    "День тихий. Я такі люблю 🍃",
-    "День як чай: якщо не поспішати — ідеально 🍵",
-]
-
-SMALLTALK = [
-    (P_HOW_ARE_YOU, R_HOW_ARE_YOU, "how"),
-    (P_WHAT_DOING_NOW, R_WHAT_DOING_NOW, "doing"),
-    (P_WHAT_DID_YESTERDAY, R_WHAT_DID_YESTERDAY, "yesterday"),
-    (P_HOW_DAY, R_HOW_DAY, "day"),
-]
-
 def _one(seq: list[str]) -> str:
     return random.choice(seq)
 
@@ -690,31 +2539,21 @@ def _dedupe_join(parts: list[str]) -> str:
         out.append(p)
     return " ".join(out).strip()
 
-TAIL_QUESTIONS = [
-    "А ти як?", "Що нового?", "Що в тебе зараз на думці?", "Розкажеш коротко?",
-]
-TAIL_VIBES = [
-    "Я поруч 🌿", "Тримаю атмосферу 💚", "Спокійно, я тут 👀",
-]
-TAIL_SUPPORT = [
-    "Якщо важко — я підтримаю 🌿", "Дихай: вдих… видих… 🍃", "Ти не один 💚",
-]
-HEADERS = ["Хей 😼", "Оу 👀", "Слухаю 🌿", "Ага ✨", ""]
-
 def combine_reply(base: str, kind: str) -> str:
     base = (base or "").strip()
     if not base:
         return base
 
+    persona = PERSONA
     parts = []
     if random.random() < 0.35:
-        h = _one(HEADERS).strip()
+        h = _one(persona.headers).strip()
         if h:
             parts.append(h)
 
     parts.append(base)
 
-    tails_pool = TAIL_VIBES + TAIL_QUESTIONS + (TAIL_SUPPORT if kind in ("how", "day") else [])
+    tails_pool = persona.tails_by_kind.get(kind, persona.tails_default)
     if random.random() < 0.60:
         parts.append(_one(tails_pool))
     if random.random() < 0.25:
@@ -725,17 +2564,20 @@ def combine_reply(base: str, kind: str) -> str:
         res = _dedupe_join(parts[:3])
     return res
 
-def detect_smalltalk(q: str) -> str | None:
+# smalltalk: комбінатор + стиль Нері одним конвеєром
+SMALLTALK_STYLE = ReplyPipeline(combine_reply, *STYLE_STAGES)
+
+SMALLTALK_BLOCK = ["вмі", "команд", "віднос", "відношенн", "ставиш", "думаєш", "хто", "покар", "накаж", "мут", "погод", "рок", "народж", "привітай", "займенник"]
+
+def match_smalltalk(q: str) -> tuple[tuple[str, ...], str] | None:
     qq = _norm_ua(q)
 
-    block = ["вмі", "команд", "віднос", "відношенн", "ставиш", "думаєш", "хто", "покар", "накаж", "мут", "погод", "рок", "народж", "привітай", "займенник"]
-    if any(b in qq for b in block):
+    if any(b in qq for b in SMALLTALK_BLOCK):
         return None
 
-    for patterns, replies, kind in SMALLTALK:
-        if _match_any(qq, patterns):
-            base = random.choice(replies)
-            return combine_reply(base, kind)
+    for rx, replies, kind in PERSONA.smalltalk:
+        if rx.search(qq):
+            return replies, kind
 
     return None
 
@@ -750,157 +2592,736 @@ def number_1_100():
     return f"🔢 Моє число: {random.randint(1, 100)}"
 
 # ===== clean =====
+_WS_RE = re.compile(r"\s+")
+
 def clean_text(text: str) -> str:
     t = text.strip()
     t = NERI_PREFIX.sub("", t)
-    t = re.sub(r"\s+", " ", t)
+    t = _WS_RE.sub(" ", t)
     return t.lower()
 
-# ===== Routes =====
-@app.get("/")
-def root():
-    return {"status": "ok", "service": "neri-chat-bot"}
+# ===== Intent router =====
+class AhoCorasick:
+    """Автомат Ахо-Корасік: усі ключові слова (підрядки) за один прохід по тексту."""
+
+    def __init__(self, words):
+        words = sorted(set(w for w in words if w))
+        goto: list[dict[str, int]] = [{}]
+        out: list[set[str]] = [set()]
+        for w in words:
+            st = 0
+            for ch in w:
+                nxt = goto[st].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[st][ch] = nxt
+                    goto.append({})
+                    out.append(set())
+                st = nxt
+            out[st].add(w)
+
+        # fail-переходи (BFS), одразу розгортаємо в повну таблицю переходів
+        fail = [0] * len(goto)
+        delta: list[dict[str, int]] = [dict(goto[0])] + [{} for _ in goto[1:]]
+        queue = deque(goto[0].values())
+        while queue:
+            st = queue.popleft()
+            out[st] |= out[fail[st]]
+            delta[st] = dict(delta[fail[st]]) if st else delta[st]
+            for ch, nxt in goto[st].items():
+                fail[nxt] = delta[fail[st]].get(ch, 0) if st else 0
+                delta[st][ch] = nxt
+                queue.append(nxt)
+
+        self._delta = delta
+        self._out = [frozenset(o) for o in out]
+
+    def scan(self, text: str) -> set[str]:
+        delta = self._delta
+        out = self._out
+        found: set[str] = set()
+        st = 0
+        for ch in text:
+            st = delta[st].get(ch, 0)
+            if out[st]:
+                found |= out[st]
+        return found
+
+
+class Intent:
+    """
+    keywords — список груп, кожна група спрацьовує на будь-який зі своїх підрядків,
+    спрацювати мають усі групи. exact — точний збіг усього запиту.
+    regex — додаткова перевірка, block — підрядки, що вимикають намір.
+    Обробник повертає відповідь (або awaitable) чи None, якщо відмовився.
+    """
 
+    def __init__(self, name: str, priority: int, handler, keywords=(), exact=(),
+                 regex: str | None = None, block=()):
+        self.name = name
+        self.priority = priority
+        self.handler = handler
+        self.groups = [frozenset((g,) if isinstance(g, str) else g) for g in keywords]
+        self.exact = frozenset(exact)
+        self.regex = re.compile(regex) if regex else None
+        self.block = frozenset(block)
+
+    def matches(self, hits: set[str], q: str, q_stripped: str) -> bool:
+        if self.exact and q_stripped not in self.exact:
+            return False
+        for g in self.groups:
+            if g.isdisjoint(hits):
+                return False
+        if self.block and not self.block.isdisjoint(hits):
+            return False
+        if self.regex and not self.regex.search(q):
+            return False
+        return True
 
-@app.post("/webhook")
-async def telegram_webhook(request: Request):
-    data = await request.json()
-    print("INCOMING UPDATE:", data)
 
-    if "message" not in data:
-        return {"ok": True}
+class IntentRouter:
+    def __init__(self, intents: list[Intent]):
+        self.intents = sorted(intents, key=lambda it: it.priority)
+        words = set()
+        for it in self.intents:
+            for g in it.groups:
+                words |= g
+            words |= it.block
+        self._ac = AhoCorasick(words)
+        # ключові слова без пробілів живуть всередині одного токена,
+        # тож збіги можна рахувати по токенах і кешувати (у чаті слова повторюються)
+        self._by_token = all(not any(ch.isspace() for ch in w) for w in words)
+        self._token_hits: dict[str, frozenset] = {}
+
+        # індекси: ключове слово / точний текст -> номери намірів
+        self._by_keyword: dict[str, list[int]] = {}
+        self._by_exact: dict[str, list[int]] = {}
+        self._always: list[int] = []
+        for i, it in enumerate(self.intents):
+            if it.exact:
+                for e in it.exact:
+                    self._by_exact.setdefault(e, []).append(i)
+            elif it.groups:
+                for w in it.groups[0]:
+                    self._by_keyword.setdefault(w, []).append(i)
+            else:
+                self._always.append(i)
+
+    def scan(self, q: str) -> set[str]:
+        if not self._by_token:
+            return self._ac.scan(q)
+        memo = self._token_hits
+        hits: set[str] = set()
+        for tok in q.split():
+            h = memo.get(tok)
+            if h is None:
+                if len(memo) >= 50_000:
+                    memo.clear()
+                h = memo[tok] = frozenset(self._ac.scan(tok))
+            if h:
+                hits |= h
+        return hits
+
+    def route(self, raw_text: str, q: str) -> tuple[str | None, object]:
+        hits = self.scan(q)
+        q_stripped = q.strip()
+
+        cand = set(self._always)
+        cand.update(self._by_exact.get(q_stripped, ()))
+        for w in hits:
+            idx = self._by_keyword.get(w)
+            if idx:
+                cand.update(idx)
+
+        for i in sorted(cand):
+            it = self.intents[i]
+            if not it.matches(hits, q, q_stripped):
+                continue
+            reply = it.handler(raw_text, q)
+            if reply:
+                return it.name, reply
+        return None, None
+
+
+START_TEXT = (
+    "Привіт ✨ Я Нері.\n\n"
+    "Я маскот і символ команди 💚🌿\n\n"
+    "Спробуй:\n"
+    "• Нері, команди\n"
+    "• Нері, привітайся\n"
+    "• Нері, погода в Києві\n"
+    "• Нері, хто такий Рум\n"
+    "• Нері, як ти відносишся до Торі\n"
+    "• Нері, покарай Торі"
+)
+
+def _weather_intent(raw_text: str, q: str):
+    cities = extract_cities_from_query(q)
+    return get_weather_many(cities, forecast_when(q)) if cities else "Скажи місто 🌿 Наприклад: «Нері, погода в Києві»"
+
+def _smalltalk_intent(raw_text: str, q: str) -> str | None:
+    m = match_smalltalk(q)
+    if not m:
+        return None
+    replies, kind = m
+    return SMALLTALK_STYLE.run(random.choice(replies), kind)
+
+# порядок = колишній ланцюжок if/elif у telegram_webhook
+NERI_INTENTS = [
+    Intent("serious", 10, lambda r, q: serious_refusal(), keywords=[tuple(SERIOUS_KEYWORDS)]),
+    Intent("hi", 20, lambda r, q: neri_style(hi_reply()),
+           exact=("привіт", "привiт", "хай", "хей", "йо", "hello", "hi")),
+    Intent("pronouns", 30, lambda r, q: neri_style(pronouns_reply()), keywords=[("займенник", "pronouns")]),
+    Intent("weather", 40, _weather_intent, keywords=["погод"]),
+    Intent("coin", 50, lambda r, q: neri_style(coin()),
+           exact=("монетка", "орел решка", "орел/решка", "орел", "решка")),
+    Intent("dice", 51, lambda r, q: neri_style(dice()), exact=("кубик", "дай кубик", "кістка")),
+    Intent("number", 52, lambda r, q: neri_style(number_1_100()),
+           exact=("число", "дай число", "рандом число", "рандомне число")),
+    Intent("random_member", 60, lambda r, q: neri_style(random_member_reply()),
+           keywords=["випадков", ("учасник", "мембер", "member")]),
+    Intent("punish", 70, handle_punish, keywords=[("покар", "накаж", "мут")]),
+    Intent("cmds", 80, lambda r, q: commands_text(), keywords=["команд"], regex=r"\bкоманд(и|а)?\b"),
+    Intent("cmds", 81, lambda r, q: commands_text(), keywords=["що", "вмі"]),
+    Intent("greet_new", 90, lambda r, q: neri_style(greet_new_member_text()), keywords=["привітай"]),
+    Intent("about", 100, lambda r, q: neri_style(random.choice(PERSONA.replies["about"])), keywords=["розкажи", "про"]),
+    Intent("about", 101, lambda r, q: neri_style(random.choice(PERSONA.replies["about"])), keywords=["хто", "ти"]),
+    Intent("interesting", 110, lambda r, q: neri_style(random.choice(PERSONA.replies["interesting"])),
+           keywords=["розкажи", ("цікав", "щось")]),
+    Intent("age", 120, lambda r, q: neri_style(random.choice(PERSONA.replies["age"])), keywords=["скільки", "рок"]),
+    Intent("age", 121, lambda r, q: neri_style(random.choice(PERSONA.replies["age"])), keywords=["вік"]),
+    Intent("bday", 130, lambda r, q: neri_style(random.choice(PERSONA.replies["bday"])), keywords=["день"]),
+    Intent("bday", 131, lambda r, q: neri_style(random.choice(PERSONA.replies["bday"])), keywords=["коли", "народж"]),
+    Intent("mom", 140, lambda r, q: neri_style(random.choice(PERSONA.replies["mom"])),
+           keywords=["хто", ("мама", "матуся", "матi", "мать")]),
+    Intent("dad", 150, lambda r, q: neri_style(random.choice(PERSONA.replies["dad"])),
+           keywords=["хто", ("тато", "татусь", "батько")]),
+    Intent("who_is", 160, answer_who_is, keywords=[("хто", "що")],
+           regex=r"\bхто\s+(такий|така|це)\b|\bщо\s+за\b|\bхто\b.*\bце\b"),
+    Intent("opinion", 170, handle_member_opinion, keywords=[("відносиш", "відношенн", "ставиш", "думаєш")]),
+    Intent("smalltalk", 180, _smalltalk_intent, block=SMALLTALK_BLOCK),
+    Intent("fallback", 1000, lambda r, q: neri_style(random.choice(PERSONA.replies["fallback"]))),
+]
 
-    message = data["message"]
-    chat_id = message["chat"]["id"]
-    raw_text = message.get("text", "")
-    text = raw_text.lower()
+# базові штуки без "нері"
+PLAIN_INTENTS = [
+    Intent("coin", 10, lambda r, q: neri_style(coin()), exact=("монетка", "орел решка")),
+    Intent("dice", 20, lambda r, q: neri_style(dice()), exact=("кубик", "дай кубик")),
+    Intent("number", 30, lambda r, q: neri_style(number_1_100()), exact=("число", "дай число")),
+]
 
-    reply = None
+NERI_ROUTER = IntentRouter(NERI_INTENTS)
+PLAIN_ROUTER = IntentRouter(PLAIN_INTENTS)
 
+def route_message(raw_text: str) -> tuple[str | None, object]:
+    """(назва наміру, відповідь). Відповідь може бути awaitable (погода)."""
+    text = raw_text.lower()
     if text == "/start":
-        reply = (
-            "Привіт ✨ Я Нері.\n\n"
-            "Я маскот і символ команди 💚🌿\n\n"
-            "Спробуй:\n"
-            "• Нері, команди\n"
-            "• Нері, привітайся\n"
-            "• Нері, погода в Києві\n"
-            "• Нері, хто такий Рум\n"
-            "• Нері, як ти відносишся до Торі\n"
-            "• Нері, покарай Торі"
-        )
+        return "start", START_TEXT
+    if text == "/help":
+        return "help", commands_text()
+    if "нері" in text:
+        return NERI_ROUTER.route(raw_text, clean_text(raw_text))
+    return PLAIN_ROUTER.route(raw_text, text)
+
+PLAIN_TRIGGERS = frozenset(w for it in PLAIN_INTENTS for w in it.exact)
+
+def is_trigger(raw_text: str) -> bool:
+    """Чи дійде повідомлення до якогось наміру — ті самі умови, що в route_message, без маршрутизації."""
+    text = raw_text.lower()
+    return "нері" in text or text in ("/start", "/help") or text.strip() in PLAIN_TRIGGERS
 
-    elif text == "/help":
-        reply = commands_text()
+UPDATES_IGNORED = register(Counter("neri_updates_ignored_total", "Updates dropped before routing: no trigger word"))
 
-    elif "нері" in text:
-        q = clean_text(raw_text)
+# ===== Update dedup (update_id) =====
+BOT_ID = (BOT_TOKEN or "").split(":", 1)[0]
 
-        # табу
-        if is_serious_topic(q):
-            reply = serious_refusal()
+class UpdateDedup:
+    """
+    Вікно останніх update_id: кільцевий буфер + set, пам'ять фіксована.
+    Telegram повторює апдейт, якщо ми відповіли повільно або з помилкою.
+    """
 
-        # ===== "Нері, привіт" ✅ ДОДАНО =====
-        elif is_hi_query(q):
-            reply = neri_style(hi_reply())
+    def __init__(self, size: int):
+        self._ring: list[int | None] = [None] * max(1, size)
+        self._pos = 0
+        self._seen: set[int] = set()
+        self.duplicates = 0
+
+    def seen(self, update_id: int) -> bool:
+        """True — вже обробляли; інакше запам'ятовує і повертає False."""
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        old = self._ring[self._pos]
+        if old is not None:
+            self._seen.discard(old)
+        self._ring[self._pos] = update_id
+        self._pos = (self._pos + 1) % len(self._ring)
+        self._seen.add(update_id)
+        return False
+
+    def forget(self, update_id: int):
+        self._seen.discard(update_id)
+
+    async def run(self, fn, *args):
+        """Той самий інтерфейс, що в SqliteUpdateDedup; пам'ять — без потоку."""
+        return fn(*args)
+
+    def stats(self) -> dict:
+        return {"window": len(self._ring), "duplicates": self.duplicates}
+
+
+class SqliteUpdateDedup:
+    """Те саме вікно у SQLite (WAL): його бачать усі воркери на цій машині."""
+
+    def __init__(self, path: str, size: int, bot_id: str):
+        self.path = path
+        self.size = max(1, size)
+        self.bot_id = bot_id
+        self._conn: sqlite3.Connection | None = None
+        self._pid = None
+        self._thread = SqliteThread("update-dedup")
+        self._inserts = 0
+        self.duplicates = 0
+
+    async def run(self, fn, *args):
+        return await self._thread.run(fn, *args)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = open_sqlite(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS updates ("
+                "bot TEXT NOT NULL, update_id INTEGER NOT NULL, PRIMARY KEY (bot, update_id))",
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    def seen(self, update_id: int) -> bool:
+        db = self._db()
+        cur = db.execute(
+            "INSERT OR IGNORE INTO updates (bot, update_id) VALUES (?, ?)",
+            (self.bot_id, update_id),
+        )
+        if cur.rowcount == 0:
+            self.duplicates += 1
+            return True
+        self._inserts += 1
+        if self._inserts % 256 == 0:
+            db.execute(
+                "DELETE FROM updates WHERE bot = ? AND update_id <= ?",
+                (self.bot_id, update_id - self.size),
+            )
+        return False
+
+    def forget(self, update_id: int):
+        self._db().execute(
+            "DELETE FROM updates WHERE bot = ? AND update_id = ?",
+            (self.bot_id, update_id),
+        )
 
-        # займенники ✅ ДОДАНО
-        elif is_pronouns_query(q):
-            reply = neri_style(pronouns_reply())
+    def stats(self) -> dict:
+        return {"window": self.size, "duplicates": self.duplicates, "shared": True}
 
-        # погода
-        elif "погод" in q or "погода" in q:
-            city = extract_city_from_query(q)
-            reply = get_weather(city) if city else "Скажи місто 🌿 Наприклад: «Нері, погода в Києві»"
 
-        # ===== ігри (монетка/кубик/число) ✅ ДОДАНО =====
-        elif q.strip() in ("монетка", "орел решка", "орел/решка", "орел", "решка"):
-            reply = neri_style(coin())
-        elif q.strip() in ("кубик", "дай кубик", "кістка"):
-            reply = neri_style(dice())
-        elif q.strip() in ("число", "дай число", "рандом число", "рандомне число"):
-            reply = neri_style(number_1_100())
+if UPDATE_DEDUP_DB:
+    update_dedup = SqliteUpdateDedup(UPDATE_DEDUP_DB, UPDATE_DEDUP_WINDOW, BOT_ID)
+else:
+    update_dedup = UpdateDedup(UPDATE_DEDUP_WINDOW)
 
-        # ===== випадковий учасник ✅ ДОДАНО =====
-        elif is_random_member_query(q):
-            reply = neri_style(random_member_reply())
+# ===== Admission (anti-flood) =====
+class AdmissionLimiter:
+    """
+    Ліміт тригер-повідомлень на чат і на учасника в чаті, до маршрутизації.
+    Ковзне вікно наближене двома сусідніми фіксованими вікнами: на ключ — 3 числа.
+    Ключі, яких не чіпали довше двох вікон, викидаються з голови OrderedDict.
+    """
 
+    def __init__(self, window: float, limits: dict[str, tuple[int, int]]):
+        self.window = window
+        self.limits = limits  # тип чату -> (на чат, на учасника); 0 — без ліміту
+        self._state: OrderedDict[object, list] = OrderedDict()
+        self.admitted = 0
+        self.dropped = 0
+
+    def _estimate(self, key, idx: int, frac: float) -> float:
+        st = self._state.get(key)
+        if st is None:
+            return 0.0
+        if st[0] != idx:
+            # зсуваємо вікна: поточне стає попереднім (або обидва порожні)
+            st[1] = st[2] if st[0] == idx - 1 else 0
+            st[2] = 0
+            st[0] = idx
+        return st[1] * (1.0 - frac) + st[2]
+
+    def _count(self, key, idx: int):
+        st = self._state.get(key)
+        if st is None:
+            st = self._state[key] = [idx, 0, 0]
         else:
-            # 0) покарай (жарт)
-            punish = handle_punish(raw_text, q)
-            if punish:
-                reply = punish
-
-            # 1) команди
-            elif is_cmds_query(q):
-                reply = commands_text()
-
-            # 2) привітання нового учасника
-            elif is_greet_new_query(q):
-                reply = neri_style(greet_new_member_text())
-
-            # 3) про себе
-            elif is_about_query(q):
-                reply = neri_style(random.choice(ABOUT_REPLIES))
-
-            # 4) щось цікаве
-            elif is_interesting_query(q):
-                reply = neri_style(random.choice(INTERESTING_REPLIES))
-
-            # 5) вік / день народження
-            elif is_age_query(q):
-                reply = neri_style(random.choice([
-                    f"Мені зараз {NERI_AGE}. Я ще молодий, але росту 🌱",
-                    f"{NERI_AGE}. І з кожним днем я квітну сильніше 🌿",
-                ]))
-
-            elif is_bday_query(q):
-                reply = neri_style(random.choice([
-                    f"Мій день народження — {NERI_BDAY} 🌿",
-                    f"Я святкую {NERI_BDAY}. Запамʼятай як теплу дату ✨",
-                ]))
-
-            # 6) мама/тато (ПРЯМО)
-            elif is_mom_query(q):
-                reply = neri_style(random.choice(MOM_REPLIES))
-
-            elif is_dad_query(q):
-                reply = neri_style(random.choice(DAD_REPLIES))
+            self._state.move_to_end(key)
+        st[2] += 1
+
+    def _evict(self, now: float):
+        horizon = int(now // self.window) - 1
+        while self._state:
+            key, st = next(iter(self._state.items()))
+            if st[0] >= horizon:
+                break
+            del self._state[key]
+
+    def admit(self, chat_id: int, chat_type: str, user_id: int | None, now: float | None = None) -> str | None:
+        """None — пропускаємо; інакше — що перевищено ("chat" чи "user")."""
+        per_chat, per_user = self.limits.get(chat_type) or self.limits.get("group", (0, 0))
+        if not per_chat and not per_user:
+            return None
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        idx = int(now // self.window)
+        frac = (now % self.window) / self.window
+
+        user_key = (chat_id, user_id)
+        if per_chat and self._estimate(chat_id, idx, frac) >= per_chat:
+            self.dropped += 1
+            return "chat"
+        if per_user and user_id is not None and self._estimate(user_key, idx, frac) >= per_user:
+            self.dropped += 1
+            return "user"
+        if per_chat:
+            self._count(chat_id, idx)
+        if per_user and user_id is not None:
+            self._count(user_key, idx)
+        self.admitted += 1
+        return None
 
-            else:
-                # 7) хто такий/така (ОКРЕМО)
-                who = answer_who_is(raw_text, q)
-                if who:
-                    reply = who
-                else:
-                    # 8) як відносишся/думаєш (ОКРЕМО)
-                    op = handle_member_opinion(raw_text, q)
-                    if op:
-                        reply = op
-                    else:
-                        # 9) smalltalk
-                        st = detect_smalltalk(q)
-                        if st:
-                            reply = neri_style(st)
-                        else:
-                            # 10) розумний фолбек
-                            reply = neri_style(random.choice([
-                                "Я підвис на сенсі 😼🌿 Дай 1–2 ключові слова — і я підхоплю ✨",
-                                "Я не зловив тему 🍃 Але я поруч. Кинь контекст одним рядком 👀",
-                                "Окей, я тут 🌿 Це про команду, про погоду, чи просто побалакати? ✨",
-                                "Я можу відповісти краще, якщо скажеш: це питання про людей/чат чи щось інше 🌱",
-                            ]))
-
-    # базові штуки без "нері" (якщо хочеш — можна прибрати)
+    def stats(self) -> dict:
+        return {"tracked": len(self._state), "admitted": self.admitted, "dropped": self.dropped}
+
+
+_group_limits = (ADMISSION_GROUP_PER_CHAT, ADMISSION_GROUP_PER_USER)
+admission = AdmissionLimiter(
+    ADMISSION_WINDOW,
+    {
+        "private": (ADMISSION_PRIVATE_PER_CHAT, 0),
+        "group": _group_limits,
+        "supergroup": _group_limits,
+    },
+)
+ADMISSION_DROPPED = register(Counter("neri_admission_dropped_total", "Trigger messages shed by the anti-flood limiter", ("chat_type", "scope")))
+
+# ===== Component metrics =====
+def _hit_ratio(hits: float, total: float) -> float:
+    return round(hits / total, 4) if total else 0.0
+
+
+def _cache_requests():
+    w = weather_cache.stats()
+    f = forecast_cache.stats()
+    g = geocode_store.stats()
+    return [
+        (("weather", "hit"), w["hits"]),
+        (("weather", "stale"), w["stale_hits"]),
+        (("weather", "miss"), w["misses"]),
+        (("forecast", "hit"), f["hits"]),
+        (("forecast", "miss"), f["misses"]),
+        (("geocode", "hit"), g["hits"]),
+        (("geocode", "miss"), g["misses"]),
+    ]
+
+
+def _cache_hit_ratio():
+    w = weather_cache.stats()
+    f = forecast_cache.stats()
+    g = geocode_store.stats()
+    w_hits = w["hits"] + w["stale_hits"]
+    return [
+        (("weather",), _hit_ratio(w_hits, w_hits + w["misses"])),
+        (("forecast",), _hit_ratio(f["hits"], f["hits"] + f["misses"])),
+        (("geocode",), _hit_ratio(g["hits"], g["hits"] + g["misses"])),
+    ]
+
+
+def _flight_calls():
+    out = []
+    for name, flight in (("geocode", geocode_flight), ("weather", weather_flight), ("forecast", forecast_flight)):
+        st = flight.stats()
+        out.append(((name, "leader"), st["calls"]))
+        out.append(((name, "coalesced"), st["coalesced"]))
+    return out
+
+
+def _outbound_messages():
+    st = dispatcher.stats()
+    return [((k,), st[k]) for k in ("sent", "inline", "retried_429", "dropped")]
+
+
+register(CallbackMetric("neri_cache_requests_total", "Cache lookups, by cache and result", "counter", ("cache", "result"), _cache_requests))
+register(CallbackMetric("neri_cache_hit_ratio", "Share of cache lookups served from cache", "gauge", ("cache",), _cache_hit_ratio))
+register(CallbackMetric("neri_weather_cache_entries", "Weather readings held in memory", "gauge", (), lambda: [((), weather_cache.stats()["size"])]))
+register(CallbackMetric("neri_singleflight_calls_total", "Upstream fetches started vs. joined an in-flight one", "counter", ("flight", "role"), _flight_calls))
+register(CallbackMetric("neri_outbound_queue_depth", "Replies waiting for a send slot", "gauge", (), lambda: [((), dispatcher.depth)]))
+register(CallbackMetric("neri_outbound_messages_total", "Outbound messages, by result", "counter", ("result",), _outbound_messages))
+register(CallbackMetric("neri_update_duplicates_total", "Retried updates dropped by update_id", "counter", (), lambda: [((), update_dedup.duplicates)]))
+register(CallbackMetric("neri_persona_info", "Persona pack version loaded by this worker", "gauge", ("version",), lambda: [((PERSONA.version,), 1)]))
+
+# ===== Routes =====
+@app.get("/")
+def root():
+    return {"status": "ok", "service": "neri-chat-bot"}
+
+
+@app.get("/ready")
+def ready():
+    # 200, щойно воркер приймає апдейти; реєстрація webhook іде фоном і видна в тілі
+    status = 200 if READINESS["serving"] else 503
+    return JSONResponse(dict(READINESS), status_code=status)
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats")
+def stats():
+    return {
+        "outbound": dispatcher.stats(),
+        "weather_cache": weather_cache.stats(),
+        "geocode_store": geocode_store.stats(),
+        "geocode_flight": geocode_flight.stats(),
+        "weather_flight": weather_flight.stats(),
+        "forecast_cache": forecast_cache.stats(),
+        "forecast_flight": forecast_flight.stats(),
+        "update_dedup": update_dedup.stats(),
+        "circuits": {name: b.stats() for name, b in owm_breakers.items()},
+        "popular_cities": [[c, round(score, 2)] for c, _, score in popularity.top(5)],
+        "polling": polling_runner.stats(),
+        "admission": admission.stats(),
+        "persona": PERSONA.version,
+    }
+
+
+@app.post("/admin/reload")
+async def admin_reload(request: Request):
+    token = request.headers.get("x-admin-token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return JSONResponse({"ok": False}, status_code=403)
+    try:
+        persona = await reload_persona()
+    except (OSError, ValueError) as e:
+        # старий пакет лишається робочим
+        log_event("persona.reload_failed", logging.ERROR, error=str(e))
+        return JSONResponse({"ok": False, "error": str(e), "version": PERSONA.version}, status_code=422)
+    return {"ok": True, "version": persona.version}
+
+
+@app.post("/webhook")
+async def telegram_webhook(request: Request):
+    # orjson по сирому тілу замість request.json(); готова відповідь без серіалізації FastAPI
+    data = orjson.loads(await request.body())
+    res = await handle_update(data, inline_ok=REPLY_IN_RESPONSE)
+    if res is None:
+        return Response(b'{"ok":true}', media_type="application/json")
+    return res
+
+
+async def handle_update(data: dict, inline_ok: bool = False) -> dict | None:
+    """
+    Обробка одного апдейту — спільна для webhook і long polling.
+    Якщо inline_ok, може повернути виклик sendMessage для тіла webhook-відповіді.
+    """
+    message = data.get("message")
+    if message is None:
+        log_event("update.skipped", logging.DEBUG, keys=list(data))
+        return None
+
+    # балачки без тригера — найчастіший випадок: ні dedup, ні логу, ні маршрутизації
+    raw_text = message.get("text", "")
+    if not is_trigger(raw_text):
+        UPDATES_IGNORED.inc()
+        return None
+
+    update_id = data.get("update_id")
+    bind_request_id(update_id)
+
+    # повтор від Telegram — підтверджуємо одразу, без маршрутизації
+    if update_id is not None and await update_dedup.run(update_dedup.seen, update_id):
+        log_event("update.duplicate", logging.DEBUG)
+        return None
+
+    chat_id = message["chat"]["id"]
+    if log_sampled():
+        log_event("update.received", chat_id=chat_id, payload=data)
     else:
-        if text.strip() in ("монетка", "орел решка"):
-            reply = neri_style(coin())
-        elif text.strip() in ("кубик", "дай кубик"):
-            reply = neri_style(dice())
-        elif text.strip() in ("число", "дай число"):
-            reply = neri_style(number_1_100())
+        log_event("update.received", chat_id=chat_id, text_len=len(raw_text))
+
+    # флуд відсікаємо до маршрутизації: без погоди, без черги на відправку
+    chat_type = message["chat"].get("type") or ("private" if chat_id > 0 else "group")
+    user_id = (message.get("from") or {}).get("id")
+    scope = admission.admit(chat_id, chat_type, user_id)
+    if scope is not None:
+        ADMISSION_DROPPED.inc(chat_type, scope)
+        log_event("update.shed", logging.DEBUG, chat_id=chat_id, user_id=user_id, scope=scope)
+        return None
 
+    started = time.perf_counter()
+    intent = None
+    try:
+        intent, reply = route_message(raw_text)
+        if inspect.isawaitable(reply):
+            if inline_ok:
+                task = spawn(reply)
+                done, _ = await asyncio.wait({task}, timeout=REPLY_INLINE_BUDGET)
+                if not done:
+                    # повільний шлях (погода) — Telegram відповідаємо одразу, текст піде окремо
+                    task.add_done_callback(lambda t: _send_task_result(chat_id, t, intent, started))
+                    return None
+                reply = task.result()
+            else:
+                reply = await reply
+    except BaseException:
+        observe_intent(intent, "error", started)
+        # не обробили — хай повтор від Telegram пройде
+        if update_id is not None:
+            spawn(update_dedup.run(update_dedup.forget, update_id))
+        raise
+    observe_intent(intent, "ok", started)
+
+    if not reply:
+        return None
+
+    if inline_ok and await dispatcher.try_acquire(chat_id):
+        return {"method": "sendMessage", "chat_id": chat_id, "text": reply}
+
+    send_message(chat_id, reply)
+    return None
+
+
+def _send_task_result(chat_id: int, task: asyncio.Task, intent: str | None, started: float):
+    if task.cancelled():
+        observe_intent(intent, "error", started)
+        return
+    if task.exception() is not None:
+        observe_intent(intent, "error", started)
+        log_event("reply.error", logging.ERROR, chat_id=chat_id, error=repr(task.exception()))
+        return
+    observe_intent(intent, "ok", started)
+    reply = task.result()
     if reply:
         send_message(chat_id, reply)
 
-    return {"ok": True}
+
+# ===== Long polling =====
+class PollingRunner:
+    """
+    getUpdates замість webhook. Апдейти різних чатів обробляються паралельно,
+    в межах одного чату — по черзі. offset підтверджує лише вже оброблені апдейти.
+    """
+
+    def __init__(self, client: TelegramClient, handler, limit: int = 100, timeout: int = 30):
+        self._client = client
+        self._handler = handler
+        self._limit = limit
+        self._timeout = timeout
+        self._next_offset: int | None = None
+        self._last_seen = -1
+        self._inflight: set[int] = set()
+        self._lanes: dict[object, deque] = {}
+        self._progress = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.processed = 0
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "in_flight": len(self._inflight),
+            "chats": len(self._lanes),
+            "processed": self.processed,
+        }
+
+    async def _wait_progress(self, timeout: float):
+        self._progress.clear()
+        try:
+            await asyncio.wait_for(self._progress.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        res = await self._client.call("deleteWebhook", {"drop_pending_updates": False})
+        log_event("webhook.removed", response=res)
+
+        while True:
+            if len(self._inflight) >= self._limit:
+                await self._wait_progress(1.0)
+                continue
+
+            # найменший необроблений апдейт лишається непідтвердженим
+            offset = min(self._inflight) if self._inflight else self._next_offset
+            payload = {"limit": self._limit, "timeout": self._timeout, "allowed_updates": ALLOWED_UPDATES}
+            if offset is not None:
+                payload["offset"] = offset
+            if self._inflight:
+                payload["timeout"] = 0
+
+            res = await self._client.call("getUpdates", payload, timeout=self._timeout + 10)
+            if res is None or not res.get("ok"):
+                if res and res.get("error_code") == 409:
+                    await self._client.call("deleteWebhook", {"drop_pending_updates": False})
+                await asyncio.sleep(2)
+                continue
+
+            fresh = [u for u in res.get("result", []) if u["update_id"] > self._last_seen]
+            for u in fresh:
+                self._dispatch(u)
+
+            if not fresh and self._inflight:
+                await self._wait_progress(0.5)
+
+    def _dispatch(self, update: dict):
+        uid = update["update_id"]
+        self._last_seen = uid
+        self._next_offset = uid + 1
+        self._inflight.add(uid)
+
+        msg = update.get("message") or {}
+        lane_key = (msg.get("chat") or {}).get("id", ("update", uid))
+        lane = self._lanes.get(lane_key)
+        if lane is None:
+            lane = self._lanes[lane_key] = deque()
+            lane.append(update)
+            spawn(self._drain(lane_key))
+        else:
+            lane.append(update)
+
+    async def _drain(self, lane_key):
+        lane = self._lanes[lane_key]
+        while lane:
+            update = lane[0]
+            try:
+                await self._handler(update)
+            except Exception as e:
+                log_event("polling.update_error", logging.ERROR, update_id=update.get("update_id"), error=repr(e))
+            lane.popleft()
+            self._inflight.discard(update["update_id"])
+            self.processed += 1
+            self._progress.set()
+        del self._lanes[lane_key]
+
+
+polling_runner = PollingRunner(tg, handle_update, limit=POLL_LIMIT, timeout=POLL_TIMEOUT)
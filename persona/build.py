@@ -0,0 +1,40 @@
+"""
+Офлайн-компіляція пакета персони.
+
+    python persona/build.py [persona/pack.json] [-o persona/pack.pickle]
+
+Перевіряє пакет і зберігає готовий Persona (індекс імен, regex smalltalk) у .pickle
+поруч із JSON. Бот бере .pickle, якщо він не старший за JSON; битий або застарілий
+.pickle ігнорує і компілює JSON сам.
+
+Щоб підхопити новий пакет без рестарту: POST /admin/reload з X-Admin-Token або
+kill -HUP <pid> — кожен з них перезавантажує лише один воркер. З SHARED_STATE_DB
+той воркер записує версію в спільний стан, і решта перечитує пакет протягом
+PERSONA_SYNC_INTERVAL (5 с); без нього воркер один. Яку версію тримає кожен воркер —
+neri_persona_info у /metrics.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("pack", nargs="?", default=main.PERSONA_PACK)
+    ap.add_argument("-o", "--out", default=None)
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    try:
+        persona = main.compile_persona(args.pack, args.out)
+    except (OSError, ValueError) as e:
+        for err in str(e).split("; "):
+            print("error:", err, file=sys.stderr)
+        sys.exit(1)
+    out = args.out or main.compiled_persona_path(args.pack)
+    print(f"persona {persona.version}: {len(persona.profiles)} profiles, "
+          f"{len(persona.smalltalk)} smalltalk kinds -> {out} ({(time.perf_counter() - t0) * 1000:.1f} ms)")